@@ -0,0 +1,476 @@
+# main.py의 성능 개선 전/후를 비교하는 벤치마크 스크립트입니다. Lambda 배포 파일(deployment.zip)에는 포함되지 않습니다.
+# 사용법 : CMD나 Powershell에서 "python bench.py"를 입력하면 전체 항목을, "python bench.py ng"처럼 입력하면 해당 항목만 측정합니다.
+
+import io
+import re
+import sys
+import time
+import random
+import timeit
+import contextlib
+
+import main
+
+HANGUL_SYLLABLES = [chr(c) for c in range(0xAC00, 0xAC00 + 400)]
+
+def random_word(rng, min_len=2, max_len=5):
+    return "".join(rng.choice(HANGUL_SYLLABLES) for _ in range(rng.randint(min_len, max_len)))
+
+def random_mention(rng, keywords=(), words=15):
+    parts = [random_word(rng, 1, 4) for _ in range(words)]
+    if keywords and rng.random() < 0.3:
+        parts.insert(rng.randrange(len(parts)), rng.choice(keywords))
+    return " ".join(parts)
+
+def report(label, seconds, count, baseline=None):
+    per_call = seconds / count * 1e6
+    ratio = f" (x{baseline / seconds:.1f})" if baseline else ""
+    print(f"  {label:<28} {per_call:10.2f} µs/건{ratio}")
+
+# 1. NG 키워드 검사: 기존 이중 루프 vs Aho-Corasick
+def legacy_check_ng_category(rules, text):
+    for category, rule in rules.items():
+        for kw in rule["keywords"]:
+            if kw in text:
+                return random.choice(rule["messages"]), kw
+    return None, None
+
+def bench_ng():
+    print("[NG 키워드 검사] check_ng_category")
+    rng = random.Random(1)
+    for size in (100, 1000, 10000):
+        keywords = list({random_word(rng) for _ in range(size)})
+        rules = {
+            f"카테고리 {i}": {"keywords": keywords[i::10], "messages": ["거절 메시지"]}
+            for i in range(10)
+        }
+        texts = [random_mention(rng, keywords) for _ in range(200)]
+
+        original = main.NG_RULES, main.NG_MATCHER
+        main.NG_RULES, main.NG_MATCHER = rules, main.compile_ng_rules(rules)
+        try:
+            for text in texts: # 결과가 같은지 먼저 확인
+                assert legacy_check_ng_category(rules, text)[1] == main.check_ng_category(text)[1]
+            legacy = timeit.timeit(lambda: [legacy_check_ng_category(rules, t) for t in texts], number=5)
+            compiled = timeit.timeit(lambda: [main.check_ng_category(t) for t in texts], number=5)
+        finally:
+            main.NG_RULES, main.NG_MATCHER = original
+
+        print(f" 키워드 {len(keywords)}개")
+        report("기존 루프", legacy, len(texts) * 5)
+        report("Aho-Corasick", compiled, len(texts) * 5, legacy)
+
+# 2. 요청 분류: 기존 classify_request(매번 리스트 생성 + any 3회 + 정규화 2회) vs 종류별로 컴파일된 정규식 search
+LEGACY_IMAGE_KEYWORDS = ["이미지", "그림", "사진"]
+LEGACY_TEXT_KEYWORDS = ["스크립트", "ss", "텍스트"]
+LEGACY_QUESTION_KEYWORDS = [
+    "질문", "궁금", "알려줘", "알려", "뭐야", "무엇", "뭐지",
+    "말해줘", "말해봐", "말해", "소개해줘", "소개", "얘기해줘", "얘기해", "이야기해줘", "이야기해"
+]
+
+def legacy_strip_josa(word):
+    josa_list = ['은', '는', '이', '가', '을', '를', '에', '에서', '에게', '한테', '보다', '도', '만', '까지', '부터', '로', '으로', '와', '과', '랑', '이나', '나']
+    for josa in sorted(josa_list, key=len, reverse=True):
+        if word.endswith(josa):
+            return word[:-len(josa)]
+    return word
+
+def legacy_normalize_text(text):
+    text = re.sub(r"@[\w\.\-]+", "", text)
+    text = text.replace("：", ":")
+    text = re.sub(r"[^\w\s가-힣]", "", text)
+    words = text.lower().strip().split()
+    return " ".join(legacy_strip_josa(w) for w in words)
+
+def legacy_families(text):
+    families = set()
+    if any(k in text for k in LEGACY_IMAGE_KEYWORDS):
+        families.add("reply_image")
+    if any(k in text for k in LEGACY_TEXT_KEYWORDS):
+        families.add("reply_text")
+    if any(k in text for k in LEGACY_QUESTION_KEYWORDS):
+        families.add("reply_question")
+    return families
+
+def legacy_classify_request(text):
+    original_text = text
+    text = legacy_normalize_text(text)
+    print(f"[DEBUG] normalize_text 결과: '{text}'")
+    families = legacy_families(text)
+    print(f"[DEBUG] classify_request() 원본: '{original_text}' → 정규화: '{text}'")
+    print(f"[DEBUG] 키워드 포함 여부 → {families}")
+    if len(families) >= 2:
+        return "ambiguous"
+    for family in ("reply_image", "reply_text", "reply_question"):
+        if family in families:
+            return family
+    print("[DEBUG] 키워드 미감지 → 자동 응답 없음")
+    return None
+
+def bench_classify():
+    print("[요청 분류] classify_request")
+    rng = random.Random(2)
+    keywords = LEGACY_IMAGE_KEYWORDS + LEGACY_TEXT_KEYWORDS + LEGACY_QUESTION_KEYWORDS
+    texts = [f"@bot.bsky.social {random_mention(rng, keywords, words=12)}?" for _ in range(20000)]
+    normalized = [main.normalize_mention(t) for t in texts]
+
+    for raw, norm in zip(texts, normalized): # 결과가 같은지 먼저 확인
+        assert legacy_normalize_text(raw) == norm.text
+        assert legacy_families(norm.text) == main.find_request_families(norm)
+
+    legacy = timeit.timeit(lambda: [legacy_families(n.text) for n in normalized], number=1)
+    compiled = timeit.timeit(lambda: [main.find_request_families(n) for n in normalized], number=1)
+    print(f" 멘션 {len(texts)}건, 분류만 (정규화된 텍스트 입력)")
+    report("기존 any() 3회", legacy, len(texts))
+    report("종류별 정규식", compiled, len(texts), legacy)
+
+    # 정규화 + 로그 출력까지 포함한 전체 호출. 기존 코드는 handle_mention/question_mention에서 정규화를 두 번 함
+    main.normalize_mention.cache_clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        legacy = timeit.timeit(lambda: [(legacy_classify_request(t), legacy_normalize_text(t)) for t in texts], number=1)
+        compiled = timeit.timeit(lambda: [(main.classify_request(t), main.normalize_mention(t)) for t in texts], number=1)
+    print(f" 멘션 {len(texts)}건, 정규화 2회 + 분류 전체")
+    report("기존 classify_request", legacy, len(texts))
+    report("컴파일 + 캐시", compiled, len(texts), legacy)
+
+# 3. 청크 분할: 기존 len() 기준 += 누적 vs 자소/바이트 기준 분할
+#    무작위 텍스트로 모든 청크가 Bluesky 제한 안에 들어가는지, 내용이 빠지거나 순서가 바뀌지 않는지 함께 검사
+CHUNK_SAMPLES = [
+    "👍", "👍🏽", "👨\u200d👩\u200d👧", "🇰🇷", "❤️", "é", "\u1100\u1161\u11a8", "ﾊﾞ", "：", "\u00a0",
+    "https://example.com/" + "a" * 40, "@someone.bsky.social", "다.", "요?", "…", "!"
+]
+
+def legacy_split_into_chunks(text, max_length=300):
+    lines = text.splitlines()
+    chunks = []
+    chunk = ""
+    for line in lines:
+        if len(chunk) + len(line) + 1 <= max_length:
+            chunk += line + "\n"
+        else:
+            chunks.append(chunk.strip())
+            chunk = line + "\n"
+    if chunk:
+        chunks.append(chunk.strip())
+    return chunks
+
+def random_chunk_text(rng):
+    lines = []
+    for _ in range(rng.randint(1, 40)):
+        words = []
+        for _ in range(rng.choice((0, 3, 10, 60, 200))): # 빈 줄부터 300자를 훌쩍 넘는 줄까지
+            word = random_word(rng, 1, 6) if rng.random() < 0.8 else rng.choice(CHUNK_SAMPLES)
+            if rng.random() < 0.02:
+                word *= rng.randint(50, 400) # 공백 없이 긴 덩어리
+            words.append(word)
+        lines.append(" ".join(words))
+    return "\n".join(lines)
+
+def check_chunks(text, chunks):
+    for chunk in chunks:
+        assert chunk and chunk == chunk.strip(), repr(chunk)
+        assert main.grapheme_len(chunk) <= main.POST_MAX_GRAPHEMES, repr(chunk)
+        assert len(chunk.encode("utf-8")) <= main.POST_MAX_BYTES, repr(chunk)
+    squeeze = lambda s: re.sub(r"\s+", "", s)
+    assert squeeze("".join(chunks)) == squeeze(text)
+
+def bench_chunks():
+    print("[청크 분할] split_into_chunks")
+    rng = random.Random(3)
+    texts = [random_chunk_text(rng) for _ in range(300)]
+
+    with contextlib.redirect_stdout(io.StringIO()): # render_chunks는 facets 추출 로그를 출력함
+        for text in texts:
+            check_chunks(text, main.split_into_chunks(text))
+            for item in main.render_chunks(text):
+                assert main.fits_post_limits(item["text"]), repr(item["text"])
+    legacy_rejected = sum(
+        not main.fits_post_limits(chunk) for text in texts for chunk in legacy_split_into_chunks(text)
+    )
+    print(f" 무작위 텍스트 {len(texts)}개 검사 통과 (기존 분할은 제한 초과 청크 {legacy_rejected}개)")
+
+    # 실제 포스트처럼 한 줄이 제한보다 짧은 한국어 텍스트
+    plain = ["\n".join(random_mention(rng, words=rng.randint(3, 20)) for _ in range(30)) for _ in range(200)]
+    legacy = timeit.timeit(lambda: [legacy_split_into_chunks(t) for t in plain], number=5)
+    current = timeit.timeit(lambda: [main.split_into_chunks(t) for t in plain], number=5)
+    print(f" 한국어 텍스트 {len(plain)}개 (30줄)")
+    report("기존 len() 분할", legacy, len(plain) * 5)
+    report("자소/바이트 분할", current, len(plain) * 5, legacy)
+
+# 4. facets 추출: 기존 URL/핸들 패턴별 탐색 + 매치마다 앞부분 재인코딩 vs 단일 토크나이저 + 누적 바이트 위치
+def legacy_extract_links(text):
+    print("[DEBUG] extract_facets 시작")
+    facets = []
+    text = re.sub(r'[\u00A0\u2000-\u200B\u202F\u205F\u3000]', ' ', text)
+    text = text.replace('：', ':')
+    print("[DEBUG] URL 패턴 검사 시작")
+    for match in main.URL_PATTERN.finditer(text):
+        url = match.group(0)
+        byte_start = len(text[:match.start()].encode("utf-8"))
+        byte_end = len(text[:match.end()].encode("utf-8"))
+        facets.append({
+            "index": {"byteStart": byte_start, "byteEnd": byte_end},
+            "features": [{"$type": "app.bsky.richtext.facet#link", "uri": url}]
+        })
+        print(f"[DEBUG] URL 감지됨: {url} (byteStart={byte_start}, byteEnd={byte_end})")
+    print("[DEBUG] 핸들 패턴 검사 시작")
+    for match in main.MENTION_PATTERN.finditer(text): # 빌드 시에는 DID 변환을 하지 않으므로 탐색만
+        pass
+    if facets:
+        print(f"[DEBUG] 총 facets 생성됨: {len(facets)}개")
+    return facets
+
+def random_link_text(rng, links):
+    parts = []
+    for i in range(links):
+        parts.append(random_mention(rng, words=rng.randint(2, 8)))
+        parts.append(f"https://example.com/{random_word(rng)}/{i}?q={rng.randint(0, 9999)}")
+    return " ".join(parts)
+
+def bench_facets():
+    print("[facets 추출] extract_facets")
+    rng = random.Random(4)
+    for links in (2, 10, 50):
+        texts = [random_link_text(rng, links) for _ in range(200)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for text in texts: # 결과가 같은지 먼저 확인
+                assert legacy_extract_links(text) == main.extract_facets(text, resolve_mentions=False)
+            legacy = timeit.timeit(lambda: [legacy_extract_links(t) for t in texts], number=5)
+            single = timeit.timeit(lambda: [main.extract_facets(t, resolve_mentions=False) for t in texts], number=5)
+        print(f" 링크 {links}개 (평균 {sum(len(t.encode('utf-8')) for t in texts) // len(texts)}바이트)")
+        report("기존 패턴별 + 재인코딩", legacy, len(texts) * 5)
+        report("단일 토크나이저", single, len(texts) * 5, legacy)
+
+    # 전각 공백/콜론이 URL 앞에 있으면 기존 방식은 위치가 밀림
+    text = "가\u3000나：다 https://example.com/a"
+    with contextlib.redirect_stdout(io.StringIO()):
+        byte_start = main.extract_facets(text, resolve_mentions=False)[0]["index"]["byteStart"]
+    assert text.encode("utf-8")[byte_start:].startswith(b"https://")
+    with contextlib.redirect_stdout(io.StringIO()):
+        legacy_start = legacy_extract_links(text)[0]["index"]["byteStart"]
+    print(f" 전각 문자 뒤 URL 위치: 기존 {legacy_start} → {byte_start}바이트")
+
+# 5. 이미지 압축: 기존 품질 5단계 하강 루프(4096px) vs 품질 이분 탐색 + 단계적 축소(2048px)
+def legacy_encode_image(image_path, max_size=1024 * 1024):
+    from PIL import Image
+    encodes = 0
+    with Image.open(image_path) as img:
+        if img.mode in ("RGBA", "P"):
+            img = img.convert("RGB")
+        img.thumbnail((4096, 4096), Image.Resampling.LANCZOS)
+        quality = 70
+        buffer = io.BytesIO()
+        while True:
+            buffer.seek(0)
+            buffer.truncate()
+            img.save(buffer, format="JPEG", quality=quality)
+            encodes += 1
+            if buffer.tell() <= max_size or quality < 30:
+                break
+            quality -= 5
+        return buffer.getvalue(), encodes
+
+def make_test_image(path, size, noise):
+    from PIL import Image
+    width, height = size
+    gradient = Image.linear_gradient("L").resize(size).convert("RGB")
+    grain = Image.effect_noise(size, noise).convert("RGB")
+    Image.blend(gradient, grain, 0.5).save(path)
+
+def bench_images():
+    print("[이미지 압축] encode_image")
+    cases = [
+        ("사진 1200x900", (1200, 900), 20),
+        ("사진 3000x2000", (3000, 2000), 40),
+        ("노이즈 4000x3000", (4000, 3000), 120),
+    ]
+    for label, size, noise in cases:
+        path = f"/tmp/bench_{size[0]}x{size[1]}.png"
+        make_test_image(path, size, noise)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = timeit.default_timer()
+            legacy_data, legacy_encodes = legacy_encode_image(path)
+            legacy = timeit.default_timer() - start
+            start = timeit.default_timer()
+            result = main.encode_image_file(path)
+            current = timeit.default_timer() - start
+        data = result.data
+        assert len(data) <= main.IMAGE_MAX_BYTES
+        print(f" {label}")
+        print(f"  {'기존 루프':<26} {legacy * 1000:8.0f} ms, 인코딩 {legacy_encodes}회, {len(legacy_data):>8} bytes"
+              f"{'' if len(legacy_data) <= main.IMAGE_MAX_BYTES else ' (업로드 불가)'}")
+        print(f"  {'이분 탐색 + 축소':<24} {current * 1000:8.0f} ms, 인코딩 {result.encodes}회, {len(data):>8} bytes"
+              f" (품질 {result.quality}, {result.size[0]}x{result.size[1]})")
+
+# 6. 큰 원본 디코딩 메모리: 전체 해상도 디코딩 vs JPEG draft / reduce() 우선
+#    tracemalloc은 파이썬 힙만 추적하고 Pillow가 C에서 할당하는 픽셀 버퍼는 보지 못하므로,
+#    이미지마다 새 프로세스에서 측정해 tracemalloc 최대치와 함께 프로세스 최대 RSS(VmHWM) 증가분과 디코딩 해상도를 같이 표시
+def full_decode_image(image_path):
+    from PIL import Image, ImageOps
+    with Image.open(image_path) as source:
+        img = ImageOps.exif_transpose(source)
+        decoded = img.size
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.thumbnail((main.IMAGE_MAX_DIMENSION, main.IMAGE_MAX_DIMENSION), Image.Resampling.LANCZOS)
+        return main.encode_to_fit(img, main.IMAGE_MAX_BYTES).data, decoded
+
+def reduced_decode_image(image_path):
+    sizes = []
+    open_reduced = main.open_reduced
+    def recording_open_reduced(source, *args):
+        img = open_reduced(source, *args)
+        sizes.append(img.size)
+        return img
+    main.open_reduced = recording_open_reduced
+    try:
+        return main.encode_image(image_path)[0], sizes[0]
+    finally:
+        main.open_reduced = open_reduced
+
+def read_proc_status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+
+def memory_probe(variant, image_path):
+    import json
+    import tracemalloc
+    decode = {"full": full_decode_image, "reduced": reduced_decode_image}[variant]
+    baseline = read_proc_status("VmRSS")
+    tracemalloc.start()
+    start = timeit.default_timer()
+    with contextlib.redirect_stdout(io.StringIO()):
+        data, decoded = decode(image_path)
+    elapsed = timeit.default_timer() - start
+    print(json.dumps({
+        "ms": elapsed * 1000,
+        "tracemalloc": tracemalloc.get_traced_memory()[1],
+        "rss": read_proc_status("VmHWM") - baseline,
+        "decoded": decoded,
+        "bytes": len(data),
+    }))
+
+def bench_memory():
+    import json
+    import subprocess
+    from PIL import Image
+    print("[디코딩 메모리] encode_image (이미지마다 새 프로세스에서 측정)")
+    cases = [
+        ("JPEG 6000x4000", "/tmp/bench_6000x4000.jpg"),
+        ("PNG 6000x4000", "/tmp/bench_6000x4000.png"),
+    ]
+    photo = Image.blend(
+        Image.linear_gradient("L").resize((6000, 4000)).convert("RGB"),
+        Image.effect_noise((6000, 4000), 40).convert("RGB"),
+        0.5
+    )
+    for _, path in cases:
+        photo.save(path, quality=92) if path.endswith(".jpg") else photo.save(path, compress_level=1)
+    del photo
+
+    mb = lambda n: f"{n / 1024 / 1024:7.1f} MB"
+    for label, path in cases:
+        print(f" {label}")
+        for variant, name in (("full", "전체 해상도 디코딩"), ("reduced", "draft / reduce 우선")):
+            out = subprocess.run(
+                [sys.executable, __file__, "--memory-probe", variant, path],
+                capture_output=True, text=True, check=True
+            ).stdout
+            r = json.loads(out.strip().splitlines()[-1])
+            print(f"  {name:<20} {r['ms']:7.0f} ms  tracemalloc {mb(r['tracemalloc'])}"
+                  f"  RSS 증가 {mb(r['rss'])}  디코딩 {r['decoded'][0]}x{r['decoded'][1]}")
+
+# 7. 스레드 게시: 이미지 차례마다 압축·업로드를 기다리는 순차 게시 vs 이미지 미리 준비(ImagePrefetcher) + 묶음 업로드
+#    네트워크는 가짜 함수(지연만 흉내)로 바꾸고, 압축은 실제로 수행 (매 실행마다 빈 캐시 폴더 사용)
+BENCH_RECORD_LATENCY = 0.15
+BENCH_UPLOAD_LATENCY = 0.4
+
+def fake_create_record(jwt, repo, collection, record):
+    time.sleep(BENCH_RECORD_LATENCY)
+    return {"uri": "at://bench", "cid": "bench"}
+
+def fake_upload_blob(jwt, image_bytes, mime_type="image/jpeg"):
+    if hasattr(image_bytes, "read"):
+        image_bytes.read()
+    time.sleep(BENCH_UPLOAD_LATENCY)
+    return {"$type": "blob", "ref": {"$link": "bench"}, "mimeType": mime_type, "size": 1}
+
+class BenchState:
+    def load_blob_ref(self, sha256):
+        return None
+    def add_blob_refs(self, items):
+        list(items)
+    def remove_blob_refs(self, hashes):
+        pass
+
+def legacy_publish_thread(jwt, did, entry):
+    parent = None
+    for planned in main.plan_thread(entry):
+        post = planned.record
+        post.pop("reply", None)
+        if not planned.images:
+            parent = main.create_record(jwt, did, "app.bsky.feed.post", post)
+            continue
+        for image_entry, image_path in zip(post["embed"]["images"], planned.images):
+            image = main.prepare_image(image_path)
+            image_entry["image"] = main.upload_blob(jwt, image.data, image.mime)
+        parent = main.create_record(jwt, did, "app.bsky.feed.post", post)
+    return parent
+
+def bench_pipeline():
+    import os
+    import shutil
+    import tempfile
+    print("[스레드 게시] publish_thread (createRecord 150 ms, uploadBlob 400 ms 가정)")
+    work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    for i in range(6):
+        make_test_image(os.path.join(work_dir, f"{i}.png"), (1600, 1200), 20 + i)
+    text_block = {"type": "text", "chunks": [{"text": "본문", "mentions": False, "facets": None}] * 3}
+    image_blocks = lambda names: [{"type": "image", "filename": f"{n}.png"} for n in names]
+    entry = {"head": "서두", "closing": "클로징",
+             "blocks": [text_block] + image_blocks(range(3)) + [text_block] + image_blocks(range(3, 6)) + [text_block]}
+
+    saved = (main.POSTS_DIR, main.IMAGE_CACHE_DIR, main.OPTIMIZED_MANIFEST_FILE, main.STATE,
+             main.create_record, main.upload_blob)
+    main.POSTS_DIR = work_dir
+    main.OPTIMIZED_MANIFEST_FILE = os.path.join(work_dir, "none.json")
+    main._optimized_manifest = None
+    main.STATE = BenchState()
+    main.create_record, main.upload_blob = fake_create_record, fake_upload_blob
+    try:
+        results = {}
+        for name, publish in (("순차 게시", lambda: legacy_publish_thread("jwt", "did", entry)),
+                              ("미리 준비 + 묶음 업로드", lambda: main.publish_thread("jwt", "did", main.plan_thread(entry), main.thread_image_paths(entry)))):
+            main.IMAGE_CACHE_DIR = tempfile.mkdtemp(dir=work_dir)
+            main._file_hashes.clear()
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = timeit.default_timer()
+                publish()
+                results[name] = timeit.default_timer() - start
+        baseline = results["순차 게시"]
+        for name, seconds in results.items():
+            print(f"  {name:<20} {seconds * 1000:8.0f} ms ({baseline / seconds:.1f}x)")
+    finally:
+        (main.POSTS_DIR, main.IMAGE_CACHE_DIR, main.OPTIMIZED_MANIFEST_FILE, main.STATE,
+         main.create_record, main.upload_blob) = saved
+        main._optimized_manifest = None
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+BENCHES = {
+    "ng": bench_ng,
+    "classify": bench_classify,
+    "chunks": bench_chunks,
+    "facets": bench_facets,
+    "images": bench_images,
+    "memory": bench_memory,
+    "pipeline": bench_pipeline,
+}
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--memory-probe"]:
+        memory_probe(*sys.argv[2:4])
+        sys.exit()
+    for name in sys.argv[1:] or BENCHES:
+        BENCHES[name]()
@@ -11,7 +11,9 @@
 # - JWT 로그인: /xrpc/com.atproto.server.createSession
 # - 포스트 업로드: /xrpc/com.atproto.repo.createRecord
 # - 이미지 업로드(blob): /xrpc/com.atproto.repo.uploadBlob
+# - JWT 갱신: /xrpc/com.atproto.server.refreshSession
 # - 알림 목록 확인: /xrpc/app.bsky.notification.listNotifications
+# - 핸들 → DID 변환: /xrpc/com.atproto.identity.resolveHandle
 
 import os
 import re
@@ -19,16 +21,76 @@ import random
 import requests
 import io
 import json
+import time
+import mmap
+import base64
+import hashlib
+import struct
+import tempfile
+import sqlite3
+import threading
 import traceback
 import unicodedata
-from datetime import datetime, timezone
-from PIL import Image
-from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # 현재 UTC 타임스탬프를 ISO 8601 형식으로 반환
 def now_timestamp():
     return datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z") # 현재 시간을 UTC로 가져오고 마이크로초를 제거한 후 ISO 8601 형식으로 반환
 
+# Bluesky XRPC 호출을 담당하는 공용 클라이언트
+# - requests.Session의 keep-alive 커넥션 풀을 모듈 전역에 두어 웜 컨테이너에서도 재사용 (매 호출마다 TCP+TLS 핸드셰이크 방지)
+# - jwt를 넘기면 Authorization 헤더를 자동으로 붙임
+# - 호출별 timeout 지정 가능 (기본값: 연결 3초, 응답 15초)
+XRPC_BASE_URL = "https://bsky.social/xrpc"
+XRPC_TIMEOUT = (3.05, 15)
+XRPC_UPLOAD_TIMEOUT = (3.05, 60) # 이미지 업로드는 응답이 오래 걸릴 수 있음
+
+class XrpcClient:
+    def __init__(self, base_url=XRPC_BASE_URL, timeout=XRPC_TIMEOUT, pool_maxsize=10):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", self.adapter)
+        self.request_count = 0
+
+    def request(self, method, nsid, jwt=None, headers=None, timeout=None, **kwargs):
+        request_headers = dict(headers or {})
+        if jwt:
+            request_headers["Authorization"] = f"Bearer {jwt}"
+        self.request_count += 1
+        res = self.session.request(
+            method,
+            f"{self.base_url}/{nsid}",
+            headers=request_headers,
+            timeout=timeout or self.timeout,
+            **kwargs
+        )
+        res.raise_for_status() # 오류 발생 시 예외를 발생시킴
+        return res.json() if res.content else {} # updateSeen 등 본문이 없는 응답도 있음
+
+    def get(self, nsid, jwt=None, params=None, **kwargs):
+        return self.request("GET", nsid, jwt=jwt, params=params, **kwargs)
+
+    def post(self, nsid, jwt=None, **kwargs):
+        return self.request("POST", nsid, jwt=jwt, **kwargs)
+
+    # 커넥션 재사용 통계: 새로 연 커넥션 수와 재사용된 요청 수
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        new_connections = sum(pools[key].num_connections for key in pools.keys())
+        return {
+            "requests": self.request_count,
+            "new_connections": new_connections,
+            "reused": max(self.request_count - new_connections, 0)
+        }
+
+XRPC = XrpcClient()
+
 HANDLE_ENV = "BLUESKY_HANDLE"
 APP_PASSWORD_ENV = "BLUESKY_APP_PASSWORD"
 
@@ -41,19 +103,127 @@ def bluesky_login():
         raise ValueError("환경 변수에서 핸들이나 앱 비밀번호를 찾을 수 없습니다.")
 
     print(f"[DEBUG] Bluesky 로그인 시도 - handle: {handle}")
-    res = requests.post(
-        "https://bsky.social/xrpc/com.atproto.server.createSession", # Bluesky 로그인 API 호출
-        json={"identifier": handle, "password": app_password},
-        headers={"Content-Type": "application/json"}
+    return XRPC.post( # 로그인 후 JWT와 DID 값을 포함한 응답 반환
+        "com.atproto.server.createSession", # Bluesky 로그인 API 호출
+        json={"identifier": handle, "password": app_password}
     )
-    res.raise_for_status() # 오류 발생 시 예외를 발생시킴
-    return res.json() # 로그인 후 JWT와 DID 값을 포함한 응답 반환
 
-def is_ignored_did(did):
-    if not os.path.exists(IGNORED_DID_FILE):
+# refreshJwt로 새 accessJwt/refreshJwt를 발급받음 (createSession보다 rate limit이 훨씬 여유로움)
+def refresh_session(refresh_jwt):
+    print("[DEBUG] Bluesky 세션 갱신 시도 (refreshSession)")
+    return XRPC.post("com.atproto.server.refreshSession", jwt=refresh_jwt)
+
+# 파일을 임시 파일에 먼저 쓴 뒤 rename 하여, 쓰는 도중 중단되어도 기존 파일이 깨지지 않게 함
+def write_file_atomic(path, data):
+    dir_name = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix=".tmp_")
+    try:
+        with (os.fdopen(fd, "wb") if isinstance(data, bytes) else os.fdopen(fd, "w", encoding="utf-8")) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_json_atomic(path, data):
+    write_file_atomic(path, json.dumps(data, ensure_ascii=False))
+
+# 세션 재사용 설정
+# - 웜 컨테이너: 모듈 전역(_session)에 남아 있는 토큰을 그대로 사용
+# - 콜드 스타트: 세션 파일에서 복원. 기본 경로(/tmp)는 같은 컨테이너 안에서만 남으므로, 새 컨테이너에서도 로그인을
+#   생략하려면 환경 변수 BLUESKY_SESSION_FILE에 EFS 등 유지되는 경로를 지정
+# - accessJwt 만료 시 refreshSession, refreshJwt까지 만료되었을 때만 createSession
+# - 로그인에 쓴 identifier(BLUESKY_HANDLE 값 그대로)를 함께 저장해, 환경 변수가 바뀌었을 때만 세션을 버림
+#   (서버가 돌려주는 handle은 이메일·대소문자·"@" 접두어로 로그인하면 환경 변수와 다르므로 비교에 쓰지 않음)
+SESSION_FILE_ENV = "BLUESKY_SESSION_FILE"
+SESSION_FILE = os.environ.get(SESSION_FILE_ENV) or "/tmp/bluesky_session.json"
+SESSION_REFRESH_MARGIN = 300 # 만료 5분 전부터는 갱신 대상으로 봄
+SESSION_KEYS = ("accessJwt", "refreshJwt", "did", "handle", "identifier")
+
+_session = {}
+
+# JWT payload의 exp(만료 시각, epoch 초)를 서명 검증 없이 로컬에서 읽음
+def decode_jwt_exp(token):
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4) # base64 패딩 복원
+        return int(json.loads(base64.urlsafe_b64decode(payload)).get("exp", 0))
+    except (AttributeError, IndexError, ValueError, TypeError):
+        return 0
+
+def is_jwt_fresh(token, margin=SESSION_REFRESH_MARGIN):
+    return bool(token) and decode_jwt_exp(token) - margin > time.time()
+
+def load_session_file():
+    if not os.path.exists(SESSION_FILE):
+        return {}
+    try:
+        with open(SESSION_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARNING] 세션 파일 읽기 실패 → 무시: {e}")
+        return {}
+
+def save_session(auth):
+    _session.clear()
+    _session.update({k: auth[k] for k in SESSION_KEYS if k in auth})
+    try:
+        write_json_atomic(SESSION_FILE, _session)
+    except OSError as e:
+        print(f"[WARNING] 세션 파일 저장 실패: {e}")
+
+# 캐시된 세션을 우선 사용하고, 필요할 때만 refreshSession / createSession 호출
+def get_session():
+    handle = os.environ.get(HANDLE_ENV)
+    auth = dict(_session) or load_session_file()
+
+    # 다른 계정으로 로그인한 세션이 남아 있다면 사용하지 않음
+    if auth and handle and auth.get("identifier") not in (None, handle):
+        print("[DEBUG] 캐시된 세션의 로그인 계정이 달라 폐기")
+        auth = {}
+
+    if auth and is_jwt_fresh(auth.get("accessJwt")):
+        print("[DEBUG] 캐시된 세션 재사용 (로그인 생략)")
+        if not _session:
+            save_session(auth)
+        return dict(_session)
+
+    if auth and is_jwt_fresh(auth.get("refreshJwt"), margin=0):
+        try:
+            save_session(dict(refresh_session(auth["refreshJwt"]), identifier=auth.get("identifier")))
+            print("[DEBUG] 세션 갱신 완료")
+            return dict(_session)
+        except requests.exceptions.HTTPError as e:
+            print(f"[WARNING] 세션 갱신 실패 → createSession으로 재로그인: {e}")
+
+    save_session(dict(bluesky_login(), identifier=handle))
+    return dict(_session)
+
+# 서버가 토큰을 거부했는지 확인. PDS는 만료·폐기된 토큰을 401 외에 400 ExpiredToken/InvalidToken으로도 알려줌
+SESSION_REJECTED_ERRORS = ("ExpiredToken", "InvalidToken")
+
+def is_session_rejected(error):
+    res = error.response
+    if res is None:
+        return False
+    if res.status_code == 401:
+        return True
+    if res.status_code != 400:
+        return False
+    try:
+        return res.json().get("error") in SESSION_REJECTED_ERRORS
+    except ValueError:
         return False
-    with open(IGNORED_DID_FILE, "r", encoding="utf-8") as f:
-        return did.strip() in [line.strip() for line in f if line.strip()]
+
+# 서버가 토큰을 거부했을 때(폐기된 세션 등) 다음 호출에서 새로 로그인하도록 캐시를 비움
+def invalidate_session():
+    _session.clear()
+    if os.path.exists(SESSION_FILE):
+        os.remove(SESSION_FILE)
+
+def is_ignored_did(did):
+    return did in BLACKLIST
 
 
 # Bluesky에 새 게시물을 생성하는 API 호출
@@ -61,89 +231,476 @@ def create_record(jwt, repo, collection, record):
     # JWT 토큰을 사용하여 게시물을 생성하는 API 호출
     try:
         print(f"[DEBUG] create_record() 호출됨. record: {json.dumps(record, ensure_ascii=False)}")
-        res = requests.post(
-            "https://bsky.social/xrpc/com.atproto.repo.createRecord",
-            headers={
-                "Authorization": f"Bearer {jwt}",
-                "Content-Type": "application/json"
-            },
+        return XRPC.post(
+            "com.atproto.repo.createRecord",
+            jwt=jwt,
             json={
                 "repo": repo,
                 "collection": collection,
                 "record": record
             }
         )
-        res.raise_for_status()
-        return res.json()
     except requests.exceptions.HTTPError as e:
         print(f"[ERROR] create_record() 실패: {e}")
         print(f"[ERROR] 요청 본문: {json.dumps(record, ensure_ascii=False)}")
         raise
 
-# 이미지를 JPEG 형식으로 압축하고 1MB 이하로 용량 조정. 
-# 해상도가 너무 클 경우 4096x4096 이내로 축소함.
-# RGBA 또는 P 모드는 RGB로 변환하고, JPEG 품질을 점차 낮춰가며 압축
-def compress_image(image_path, max_size=1024 * 1024):
+# 압축 이미지 캐시
+# - 원본 파일 내용의 SHA-256과 인코더 설정(버전, 목표 용량)으로 키를 만들어, 같은 이미지는 Pillow로 다시 디코딩/인코딩하지 않고 캐시 파일을 그대로 사용
+# - /tmp/image_cache에 저장 (웜 컨테이너와 같은 컨테이너의 다음 실행에서 재사용)
+# - /tmp 캐시가 IMAGE_CACHE_MAX_BYTES를 넘으면 가장 오래 쓰지 않은(mtime이 오래된) 파일부터 삭제. 캐시를 읽을 때 mtime을 갱신함
+IMAGE_CACHE_DIR = "/tmp/image_cache"
+IMAGE_CACHE_MAX_BYTES = 200 * 1024 * 1024 # /tmp 기본 용량(512MB)의 절반 이하
+IMAGE_CACHE_MIME = {".jpg": "image/jpeg", ".png": "image/png"}
+IMAGE_ENCODER_VERSION = 3 # encode_image의 동작을 바꾸면 올려서 예전 캐시를 무효화
+IMAGE_MAX_BYTES = 1000000 # Bluesky 이미지 blob 최대 크기
+
+_file_hashes = {} # 경로 → (mtime, 크기, SHA-256). 파일이 바뀌지 않았으면 다시 해시하지 않음
+
+def file_sha256(path):
+    stat = os.stat(path)
+    cached = _file_hashes.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    _file_hashes[path] = (stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+    return digest.hexdigest()
+
+def image_cache_key(image_path, max_size=IMAGE_MAX_BYTES):
+    settings = f"{file_sha256(image_path)}:v{IMAGE_ENCODER_VERSION}:{max_size}"
+    return hashlib.sha256(settings.encode("utf-8")).hexdigest()
+
+def read_cached_image(key):
+    for ext, mime in IMAGE_CACHE_MIME.items():
+        path = os.path.join(IMAGE_CACHE_DIR, key + ext)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            continue
+        try:
+            os.utime(path) # LRU 순서 갱신
+        except OSError:
+            pass
+        return data, mime
+    return None
+
+def write_cached_image(key, data, mime, cache_dir=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES):
+    ext = next(ext for ext, cached_mime in IMAGE_CACHE_MIME.items() if cached_mime == mime)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_file_atomic(os.path.join(cache_dir, key + ext), data)
+        if max_bytes:
+            evict_image_cache(cache_dir, max_bytes)
+    except OSError as e:
+        print(f"[WARNING] 이미지 캐시 저장 실패: {e}")
+
+# 캐시 폴더 전체 용량이 max_bytes 이하가 될 때까지 mtime이 오래된 파일부터 삭제
+def evict_image_cache(cache_dir, max_bytes):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.startswith(".tmp_"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            print(f"[DEBUG] 이미지 캐시 삭제: {os.path.basename(path)}")
+        except OSError:
+            pass
+
+# 이미지를 Bluesky 업로드용으로 압축 (캐시에 있으면 그대로 반환)
+def compress_image(image_path, max_size=IMAGE_MAX_BYTES):
+    key = image_cache_key(image_path, max_size)
+    cached = read_cached_image(key)
+    if cached:
+        print(f"[DEBUG] 압축 이미지 캐시 사용: {image_path}")
+        return cached
+    image_bytes, mime = encode_image(image_path, max_size)
+    write_cached_image(key, image_bytes, mime)
+    return image_bytes, mime
+
+# 이미지 인코더 설정
+# - Bluesky 제한: 긴 변 2048px, 파일 크기 1,000,000바이트
+# - 품질은 IMAGE_QUALITY_MIN~MAX 사이에서 이분 탐색해 용량 안에 들어가는 가장 높은 품질을 고름
+# - 최저 품질로도 넘치면 해상도를 단계적으로 줄여 다시 탐색 (원본에서 바로 축소해 화질 손실이 쌓이지 않게 함)
+IMAGE_MAX_DIMENSION = 2048
+IMAGE_QUALITY_MAX = 80
+IMAGE_QUALITY_MIN = 40
+IMAGE_QUALITY_TOLERANCE = 3 # 이 차이 이내로 좁혀지면 탐색 종료
+IMAGE_MIN_DIMENSION = 256
+
+ImageEncoding = namedtuple("ImageEncoding", ["data", "quality", "size", "encodes"])
+
+def encode_jpeg(img, quality):
+    buffer = io.BytesIO() # 메모리 내 임시 버퍼
+    img.save(buffer, format="JPEG", quality=quality) # EXIF 등 메타데이터는 넘기지 않으므로 저장되지 않음
+    return buffer.getvalue()
+
+# 해상도를 유지한 채 max_size 이하가 되는 가장 높은 품질을 이분 탐색
+# (결과, 품질, 인코딩 횟수, 결과 용량)을 반환하고, 최저 품질로도 넘치면 결과는 None, 용량은 최저 품질 결과의 용량
+def search_jpeg_quality(img, max_size):
+    data = encode_jpeg(img, IMAGE_QUALITY_MAX)
+    if len(data) <= max_size:
+        return data, IMAGE_QUALITY_MAX, 1, len(data)
+    smallest = encode_jpeg(img, IMAGE_QUALITY_MIN)
+    if len(smallest) > max_size:
+        return None, IMAGE_QUALITY_MIN, 2, len(smallest)
+
+    best, low, high, encodes = smallest, IMAGE_QUALITY_MIN, IMAGE_QUALITY_MAX, 2
+    while high - low > IMAGE_QUALITY_TOLERANCE:
+        quality = (low + high) // 2
+        data = encode_jpeg(img, quality)
+        encodes += 1
+        if len(data) <= max_size:
+            best, low = data, quality
+        else:
+            high = quality
+    return best, low, encodes, len(best)
+
+# 용량 목표에 맞춰 인코딩. 품질 탐색 → 안 되면 해상도 축소 후 다시 탐색
+def encode_to_fit(img, max_size):
+    from PIL import Image
+    base = img
+    encodes = 0
+    while True:
+        data, quality, count, data_size = search_jpeg_quality(img, max_size)
+        encodes += count
+        if data is not None:
+            return ImageEncoding(data, quality, img.size, encodes)
+        if max(img.size) <= IMAGE_MIN_DIMENSION:
+            print(f"[WARNING] 최소 해상도에서도 용량 초과: {data_size} bytes")
+            return ImageEncoding(encode_jpeg(img, IMAGE_QUALITY_MIN), IMAGE_QUALITY_MIN, img.size, encodes + 1)
+        # 최저 품질 결과의 용량을 보고 면적 비율만큼 축소 (한 번에 절반 이하로는 줄이지 않음)
+        scale = max(0.5, min(0.9, (max_size / data_size) ** 0.5 * 0.95))
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        print(f"[DEBUG] 최저 품질로도 {data_size} bytes → 해상도 축소: {img.size} → {size}")
+        img = base.resize(size, Image.Resampling.LANCZOS)
+
+# 큰 원본을 디코딩할 때의 메모리/CPU 절약
+# - JPEG: draft 모드로 디코더가 처음부터 1/2, 1/4, 1/8 해상도로 풀게 함 (전체 해상도 픽셀을 만들지 않음)
+# - PNG 등: 전체 디코딩은 피할 수 없으므로, 모드 변환과 LANCZOS 축소 전에 reduce()로 먼저 정수배 축소해 큰 버퍼가 하나만 생기게 함
+# - 미리 줄이는 건 목표 해상도(의 IMAGE_REDUCE_GAP배)보다 작아지지 않는 데까지만 하고, 나머지는 LANCZOS로 축소
+IMAGE_REDUCE_GAP = 1
+REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA", "CMYK", "YCbCr", "I", "F")
+
+# EXIF 방향 값 → 픽셀에 적용할 변환 (ImageOps.exif_transpose와 같은 표)
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: "FLIP_LEFT_RIGHT",
+    3: "ROTATE_180",
+    4: "FLIP_TOP_BOTTOM",
+    5: "TRANSPOSE",
+    6: "ROTATE_270",
+    7: "TRANSVERSE",
+    8: "ROTATE_90",
+}
+
+# 원본을 목표 해상도 근처까지 줄여서 디코딩
+def open_reduced(source, max_dimension=IMAGE_MAX_DIMENSION):
+    width, height = source.size
+    limit = max_dimension * IMAGE_REDUCE_GAP
+    if max(width, height) <= limit:
+        return source
+    if source.format == "JPEG":
+        ratio = limit / max(width, height)
+        source.draft("RGB", (int(width * ratio) + 1, int(height * ratio) + 1))
+        if source.size != (width, height):
+            print(f"[DEBUG] JPEG draft 디코딩: {(width, height)} → {source.size}")
+        return source
+
+    factor = max(width, height) // limit
+    if factor >= 2:
+        img = source if source.mode in REDUCIBLE_MODES else source.convert("RGB") # 팔레트(P) 등 reduce()가 안 되는 모드
+        print(f"[DEBUG] 정수배 축소: {(width, height)} → 1/{factor}")
+        return img.reduce(factor)
+    return source
+
+# 이미지를 Bluesky 업로드용 JPEG로 압축
+# 줄여서 디코딩 → RGB 변환 → 긴 변 2048px 이내로 축소 → EXIF 방향 적용(작아진 이미지에서 회전) → 용량 목표에 맞춰 인코딩
+# EXIF 등 메타데이터는 저장하지 않음
+# Pillow는 여기서 처음 import (미리 최적화된 이미지만 쓰는 실행에서는 Pillow를 불러오지 않음)
+def encode_image_file(image_path, max_size=IMAGE_MAX_BYTES):
+    from PIL import Image
     print(f"[DEBUG] 이미지 압축 시작: {image_path}")
-    with Image.open(image_path) as img:
-        if img.mode in ("RGBA", "P"):
-            img = img.convert("RGB") # 이미지 모드가 RGBA 또는 P일 경우 RGB로 변환
-
-        # 해상도 제한: 4096x4096
-        max_dimensions = (4096, 4096)
-        original_size = img.size
-        img.thumbnail(max_dimensions, Image.Resampling.LANCZOS) # 이미지 축소
+    with Image.open(image_path) as source:
+        orientation = source.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        original_size = source.size
+        img = open_reduced(source)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB") # RGBA, P, CMYK 등은 JPEG로 저장할 수 있게 RGB로 변환
+
+        img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.Resampling.LANCZOS) # 이미지 축소
         if img.size != original_size:
             print(f"[DEBUG] 이미지 해상도 축소됨: {original_size} → {img.size}")
+        if orientation in EXIF_ORIENTATION_TRANSPOSE: # 회전 정보가 있는 사진도 올바른 방향으로
+            img = img.transpose(getattr(Image.Transpose, EXIF_ORIENTATION_TRANSPOSE[orientation]))
 
-        quality = 70  # 품질을 70으로 설정하여 더 낮은 용량을 목표
-        buffer = io.BytesIO() # 메모리 내 임시 버퍼
-        while True:
-            buffer.seek(0)
-            buffer.truncate()
-            img.save(buffer, format="JPEG", quality=quality) # 이미지 저장
-            print(f"[DEBUG] 이미지 용량: {buffer.tell()} bytes, 품질: {quality}")
-            if buffer.tell() <= max_size or quality < 30: # 용량이 1MB 이하로 되거나 품질이 30 미만일 경우 종료
-                break
-            quality -= 5 # 품질을 낮추어 다시 시도
+        result = encode_to_fit(img, max_size)
+        print(f"[DEBUG] 이미지 인코딩 {result.encodes}회: {len(result.data)} bytes, 품질 {result.quality}, 해상도 {result.size}")
+        return result
 
-        if buffer.tell() > max_size:
-            print(f"[WARNING] 최종 이미지 용량이 여전히 {buffer.tell()} bytes로 커서 품질을 더 낮출 예정입니다.")
+def encode_image(image_path, max_size=IMAGE_MAX_BYTES):
+    return encode_image_file(image_path, max_size).data, "image/jpeg" # 압축된 이미지 반환
 
-        buffer.seek(0)
-        return buffer.read(), "image/jpeg" # 압축된 이미지 반환
+# 배포 전에 최적화해 둔 이미지 (zip_builder.py가 build_optimized_images로 생성)
+# - quotes/posts, quotes/reply_images의 이미지를 Bluesky용 JPEG로 미리 변환해 quotes/optimized에 저장하고,
+#   manifest.json에 원본 경로별로 결과 파일명, 원본 해시/크기, 인코더 버전, 결과 해시/크기, MIME, 가로세로 비율을 기록
+# - 런타임에는 매니페스트에 있는 이미지를 Pillow 없이 파일 그대로 스트리밍 업로드
+# - 매니페스트에 없거나 원본 크기/인코더 버전이 다르면 compress_image(캐시 → Pillow)로 대체
+QUOTES_DIR = "./quotes"
+OPTIMIZED_IMAGES_DIR = "./quotes/optimized"
+OPTIMIZED_MANIFEST_FILE = "./quotes/optimized/manifest.json"
+
+# 업로드할 이미지. 미리 최적화된 파일이면 path, 런타임에 압축했으면 data에 내용이 들어 있음
+PreparedImage = namedtuple("PreparedImage", ["path", "data", "mime", "sha256", "aspect_ratio"])
+
+_optimized_manifest = None
+
+def manifest_key(image_path):
+    return os.path.relpath(image_path, QUOTES_DIR).replace(os.sep, "/")
+
+def read_optimized_manifest():
+    try:
+        with open(OPTIMIZED_MANIFEST_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_optimized_manifest():
+    global _optimized_manifest
+    if _optimized_manifest is None:
+        _optimized_manifest = read_optimized_manifest()
+    return _optimized_manifest
+
+def prepare_image(image_path):
+    entry = load_optimized_manifest().get(manifest_key(image_path))
+    if entry and entry["encoder"] == IMAGE_ENCODER_VERSION:
+        optimized_path = os.path.join(OPTIMIZED_IMAGES_DIR, entry["file"])
+        try:
+            if os.path.getsize(image_path) == entry["source_size"] and os.path.exists(optimized_path):
+                print(f"[DEBUG] 미리 최적화된 이미지 사용: {image_path} → {optimized_path}")
+                return PreparedImage(optimized_path, None, entry["mime"], entry["sha256"], entry["aspectRatio"])
+        except OSError:
+            pass
+    image_bytes, mime = compress_image(image_path)
+    return PreparedImage(None, image_bytes, mime, hashlib.sha256(image_bytes).hexdigest(), None)
+
+# zip_builder.py의 프로세스 풀에서 실행되는 변환 작업. 원본 하나를 변환해 저장하고 매니페스트 항목을 반환
+def optimize_image_file(image_path, output_path, source_sha256):
+    result = encode_image_file(image_path)
+    write_file_atomic(output_path, result.data)
+    return {
+        "file": os.path.basename(output_path),
+        "source_sha256": source_sha256,
+        "source_size": os.path.getsize(image_path),
+        "encoder": IMAGE_ENCODER_VERSION,
+        "sha256": hashlib.sha256(result.data).hexdigest(),
+        "size": len(result.data),
+        "mime": "image/jpeg",
+        "aspectRatio": {"width": result.size[0], "height": result.size[1]}
+    }
+
+# quotes/posts, quotes/reply_images의 모든 이미지를 여러 프로세스에서 동시에 변환 (zip_builder.py에서 호출)
+# 원본 해시와 인코더 버전이 지난 빌드와 같은 이미지는 건너뛰고, 더 이상 쓰지 않는 결과 파일은 지움
+def build_optimized_images(max_workers=None):
+    os.makedirs(OPTIMIZED_IMAGES_DIR, exist_ok=True)
+    previous = read_optimized_manifest()
+    manifest = {}
+    jobs = {}
+    for image_dir in (POSTS_DIR, REPLY_IMAGES_DIR):
+        if not os.path.isdir(image_dir):
+            continue
+        for filename in sorted(os.listdir(image_dir)):
+            if not filename.lower().endswith(REPLY_IMAGE_EXTS):
+                continue
+            image_path = os.path.join(image_dir, filename)
+            key = manifest_key(image_path)
+            source_sha256 = file_sha256(image_path)
+            entry = previous.get(key)
+            if (entry and entry["source_sha256"] == source_sha256 and entry["encoder"] == IMAGE_ENCODER_VERSION
+                    and os.path.exists(os.path.join(OPTIMIZED_IMAGES_DIR, entry["file"]))):
+                manifest[key] = entry
+                continue
+            jobs[key] = (image_path, os.path.join(OPTIMIZED_IMAGES_DIR, f"{source_sha256}.jpg"), source_sha256)
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {key: executor.submit(optimize_image_file, *args) for key, args in jobs.items()}
+            for key, future in futures.items():
+                manifest[key] = future.result()
+
+    used_files = {entry["file"] for entry in manifest.values()}
+    for filename in os.listdir(OPTIMIZED_IMAGES_DIR):
+        if filename != os.path.basename(OPTIMIZED_MANIFEST_FILE) and filename not in used_files:
+            os.remove(os.path.join(OPTIMIZED_IMAGES_DIR, filename))
+    write_json_atomic(OPTIMIZED_MANIFEST_FILE, dict(sorted(manifest.items())))
+    print(f"[INFO] 이미지 최적화: {OPTIMIZED_IMAGES_DIR} (변환 {len(jobs)}개, 변경 없음 {len(manifest) - len(jobs)}개)")
 
 # 압축된 이미지를 Bluesky 서버에 업로드하여 blob 참조를 생성
+# image_bytes에는 바이트 대신 파일 객체도 넘길 수 있음 (파일 내용을 메모리에 올리지 않고 스트리밍)
 def upload_blob(jwt, image_bytes, mime_type="image/jpeg"):
-    headers = {
-        "Authorization": f"Bearer {jwt}", # 인증을 위한 JWT 토큰
-        "Content-Type": "application/octet-stream", # 이미지 데이터 타입
-    }
-    res = requests.post(
-        "https://bsky.social/xrpc/com.atproto.repo.uploadBlob", # Bluesky API 호출
-        headers=headers,
-        data=image_bytes # 이미지 바이트 데이터 전송
+    res = XRPC.post(
+        "com.atproto.repo.uploadBlob", # Bluesky API 호출
+        jwt=jwt, # 인증을 위한 JWT 토큰
+        headers={"Content-Type": mime_type}, # 이미지 데이터 타입
+        data=image_bytes, # 이미지 바이트 데이터 전송
+        timeout=XRPC_UPLOAD_TIMEOUT
     )
-    res.raise_for_status() # 오류 발생 시 예외를 발생시킴
-    return res.json()["blob"] # 업로드된 이미지의 blob 참조 반환
-
+    return res["blob"] # 업로드된 이미지의 blob 참조 반환
+
+# 이미지 blob 재사용
+# - 이미지 내용의 SHA-256 → blob 참조(CID, mimeType, size)를 상태 DB(blob_refs)에 기록해두고, 같은 이미지는 uploadBlob 없이 참조만 다시 사용
+# - 레코드가 참조하지 않는 blob은 PDS에서 곧 지워지므로, createRecord가 성공한 뒤에만 기록
+# - PDS가 예전 참조를 거부하면(blob이 정리된 경우 등) 기록을 지우고 다시 업로드해서 한 번 더 시도
+def is_blob_rejected(error):
+    res = error.response
+    return res is not None and res.status_code == 400 and "blob" in res.text.lower()
+
+def upload_prepared_image(jwt, image):
+    if image.path:
+        with open(image.path, "rb") as f:
+            return upload_blob(jwt, f, image.mime)
+    return upload_blob(jwt, image.data, image.mime)
+
+# 이미지 준비(압축)와 업로드를 병렬로 처리하는 스레드 풀
+# - Pillow의 디코드/인코드와 HTTP 업로드는 GIL을 놓고 돌기 때문에 스레드로도 동시에 진행됨
+# - 압축과 업로드는 풀을 나눠, 미리 걸어둔 압축 작업이 많아도 업로드가 그 뒤에 줄 서지 않게 함
+# - 상태 DB(sqlite) 연결은 스레드 간에 공유하지 않으므로, blob 재사용 조회와 기록은 호출한 스레드에서만 함
+IMAGE_WORKERS = 4 # 압축 스레드 수
+IMAGE_UPLOAD_WORKERS = 4 # 업로드 스레드 수 (XRPC 연결 풀 크기 10 이하)
+IMAGE_POST_MAX_IMAGES = 4 # app.bsky.embed.images 한 개에 넣을 수 있는 최대 이미지 수
+
+_image_executor = None
+_upload_executor = None
+
+def image_executor():
+    global _image_executor
+    if _image_executor is None:
+        _image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+    return _image_executor
+
+def upload_executor():
+    global _upload_executor
+    if _upload_executor is None:
+        _upload_executor = ThreadPoolExecutor(max_workers=IMAGE_UPLOAD_WORKERS, thread_name_prefix="upload")
+    return _upload_executor
+
+# 여러 이미지를 동시에 업로드해 같은 순서의 blob 참조 목록으로 반환
+def upload_prepared_images(jwt, images):
+    futures = [upload_executor().submit(upload_prepared_image, jwt, image) for image in images]
+    return [future.result() for future in futures]
+
+# images: post["embed"]["images"]와 같은 순서의 PreparedImage 목록. 각 항목의 image 자리를 blob으로 채워 게시
+# uploaded: 미리 업로드해둔 blob 목록 (images와 같은 순서, 없는 자리는 None → blob 재사용 조회 또는 업로드)
+def create_image_post(jwt, repo, post, images, uploaded=None):
+    image_entries = post["embed"]["images"]
+    hashes = [image.sha256 for image in images]
+    blobs = list(uploaded) if uploaded else [None] * len(images)
+    reused = False
+    for i, sha256 in enumerate(hashes):
+        if not blobs[i]:
+            blobs[i] = STATE.load_blob_ref(sha256)
+            if blobs[i]:
+                reused = True
+                print(f"[DEBUG] 업로드된 blob 재사용: {image_entries[i]['alt']}")
+    missing = [i for i, blob in enumerate(blobs) if not blob]
+    for i, blob in zip(missing, upload_prepared_images(jwt, [images[i] for i in missing])):
+        blobs[i] = blob
+    for image_entry, image, blob in zip(image_entries, images, blobs):
+        image_entry["image"] = blob
+        if image.aspect_ratio:
+            image_entry["aspectRatio"] = image.aspect_ratio
 
-# 잔처리 함수
-def normalize_text(text):
-    text = re.sub(r"@[\w\.\-]+", "", text)
-    text = text.replace("：", ":")
-    text = re.sub(r"[^\w\s가-힣]", "", text)
-    words = text.lower().strip().split()
-    words = [strip_josa(w) for w in words]
-    return " ".join(words)
+    try:
+        result = create_record(jwt, repo, "app.bsky.feed.post", post)
+    except requests.exceptions.HTTPError as e:
+        if not reused or not is_blob_rejected(e):
+            raise
+        print(f"[WARNING] 저장된 blob 참조가 거부되어 다시 업로드: {e.response.text[:200]}")
+        STATE.remove_blob_refs(hashes)
+        for image_entry, blob in zip(image_entries, upload_prepared_images(jwt, images)):
+            image_entry["image"] = blob
+        result = create_record(jwt, repo, "app.bsky.feed.post", post)
+
+    STATE.add_blob_refs(zip(hashes, (image_entry["image"] for image_entry in image_entries)))
+    return result
+
+
+# 다중 키워드 매칭기 (Aho-Corasick)
+# 키워드 목록을 한 번 컴파일해두면, 키워드가 아무리 많아도 텍스트를 한 번만 훑어서 모든 일치 항목을 찾음.
+# add()로 (키워드, 값)을 등록하고 build() 후 iter_matches()로 (시작 위치, 키워드, 값)을 받음
+class AhoCorasick:
+    def __init__(self):
+        self.goto = [{}] # 노드별 다음 글자 → 노드 번호
+        self.fail = [0] # 실패 링크
+        self.outputs = [[]] # 노드에서 끝나는 (키워드, 값) 목록
+
+    def add(self, keyword, value=None):
+        if not keyword:
+            return
+        node = 0
+        for ch in keyword:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            node = nxt
+        self.outputs[node].append((keyword, value))
+
+    # BFS로 실패 링크를 만들고, 실패 링크 쪽의 출력도 미리 합쳐둠
+    def build(self):
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for ch, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.outputs[nxt] = self.outputs[nxt] + self.outputs[self.fail[nxt]]
+                queue.append(nxt)
+        return self
+
+    def iter_matches(self, text):
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for keyword, value in outputs[node]:
+                yield i - len(keyword) + 1, keyword, value
+
+# 전처리 함수
+# - 핸들(@xxx)과 특수문자(전각 콜론 포함)를 정규식 한 번으로 제거하고, 단어마다 조사를 떼어냄
+# - 같은 멘션 텍스트는 캐시(LRU)에서 바로 반환하므로 classify_request, question_mention 등이
+#   같은 멘션을 여러 번 정규화하지 않고 결과(text, words)를 공유함
+NORMALIZE_STRIP_PATTERN = re.compile(r"@[\w.\-]+|[^\w\s]")
+NormalizedText = namedtuple("NormalizedText", ["text", "words"])
+
+@lru_cache(maxsize=1024)
+def normalize_mention(text):
+    text = NORMALIZE_STRIP_PATTERN.sub("", text)
+    words = tuple(strip_josa(w) for w in text.lower().split())
+    return NormalizedText(" ".join(words), words)
 
 # 조사 제거 함수 - 질문이나 뭐 출력해달라고 할 때 키워드를 확실히 인식되게끔 함.
+# 조사 목록을 긴 것부터 하나의 정규식으로 묶어 끝부분에서 한 번만 매칭 (가장 긴 조사가 먼저 제거됨)
+JOSA_LIST = ['은', '는', '이', '가', '을', '를', '에', '에서', '에게', '한테', '보다', '도', '만', '까지', '부터', '로', '으로', '와', '과', '랑', '이나', '나']
+JOSA_PATTERN = re.compile("(?:" + "|".join(sorted(JOSA_LIST, key=len, reverse=True)) + ")$")
+
 def strip_josa(word):
-    josa_list = ['은', '는', '이', '가', '을', '를', '에', '에서', '에게', '한테', '보다', '도', '만', '까지', '부터', '로', '으로', '와', '과', '랑', '이나', '나']
-    for josa in sorted(josa_list, key=len, reverse=True):  # 긴 조사 먼저
-        if word.endswith(josa):
-            return word[:-len(josa)]
-    return word
+    return JOSA_PATTERN.sub("", word, count=1)
 
 
 POSTS_DIR = "./quotes/posts"
@@ -151,6 +708,113 @@ REPLIES_DIR = "./quotes/replies"
 REPLY_IMAGES_DIR = "./quotes/reply_images"
 REPLY_QUESTION_DIR = "./quotes/reply_questions"
 
+# 패킹된 코퍼스 (quotes/corpus.pack, zip_builder.py가 생성)
+# 작은 .txt 파일 여러 개 대신 파일 하나에 모든 텍스트를 담고 mmap으로 읽음. 랜덤으로 고른 항목 하나만 디코딩함.
+# 파일 구조:
+#   [매직 8바이트][헤더 길이 uint32][헤더 JSON][오프셋 테이블: 항목마다 (오프셋 uint64, 길이 uint32)][UTF-8 본문들]
+#   헤더: {"sections": {"posts": [시작 번호, 개수], "replies": [...], "questions": [...]},
+#          "names": {"questions": {"파일명.txt": 섹션 내 번호}},
+#          "sources": {"posts/파일명.txt": 크기, ...}}
+#   - posts: materialize_post(parse_post()) 결과(JSON), replies: 답변 청크, questions: 질문 응답 파일 내용
+#   - sources: 팩을 만들 때의 원본 .txt 파일 목록. 지금 파일과 다르면 팩이 오래된 것이므로 쓰지 않고 텍스트 파일을 직접 읽음
+#     (zip_builder.py 없이 원본만 고쳐서 압축한 경우 등)
+CORPUS_PACK_FILE = "./quotes/corpus.pack"
+CORPUS_PACK_MAGIC = b"BSKYCP01"
+CORPUS_PACK_ENTRY = struct.Struct("<QI")
+
+class PackedCorpus:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(CORPUS_PACK_MAGIC)] != CORPUS_PACK_MAGIC:
+            raise ValueError(f"코퍼스 팩 형식이 아닙니다: {path}")
+        header_start = len(CORPUS_PACK_MAGIC) + 4
+        (header_len,) = struct.unpack_from("<I", self.mm, len(CORPUS_PACK_MAGIC))
+        header = json.loads(self.mm[header_start:header_start + header_len].decode("utf-8"))
+        self.sections = header["sections"]
+        self.names = header.get("names", {})
+        self.sources = header.get("sources")
+        self.table_start = header_start + header_len
+
+    def count(self, section):
+        return self.sections.get(section, [0, 0])[1]
+
+    # 섹션 안의 index번째 항목만 잘라서 디코딩
+    def get(self, section, index):
+        start, count = self.sections[section]
+        if not 0 <= index < count:
+            raise IndexError(index)
+        offset, length = CORPUS_PACK_ENTRY.unpack_from(self.mm, self.table_start + (start + index) * CORPUS_PACK_ENTRY.size)
+        return self.mm[offset:offset + length].decode("utf-8")
+
+    def random(self, section):
+        count = self.count(section)
+        return self.get(section, random.randrange(count)) if count else None
+
+    def get_by_name(self, section, name):
+        index = self.names.get(section, {}).get(name)
+        return None if index is None else self.get(section, index)
+
+# 팩 파일 생성 (zip_builder.py에서 호출). sections: {섹션명: [문자열, ...]}, names: {섹션명: {이름: 번호}}
+def write_corpus_pack(path, sections, names=None, sources=None):
+    payloads = []
+    section_table = {}
+    for section, items in sections.items():
+        section_table[section] = [len(payloads), len(items)]
+        payloads.extend(item.encode("utf-8") for item in items)
+
+    header = json.dumps({"sections": section_table, "names": names or {}, "sources": sources or {}}, ensure_ascii=False).encode("utf-8")
+    offset = len(CORPUS_PACK_MAGIC) + 4 + len(header) + CORPUS_PACK_ENTRY.size * len(payloads)
+    table = bytearray()
+    for payload in payloads:
+        table += CORPUS_PACK_ENTRY.pack(offset, len(payload))
+        offset += len(payload)
+
+    write_file_atomic(path, b"".join([CORPUS_PACK_MAGIC, struct.pack("<I", len(header)), header, bytes(table)] + payloads))
+
+# 팩에 들어가는 원본 .txt 파일의 ("섹션/파일명", 경로) 목록
+def corpus_source_files():
+    for section, source_dir in (("posts", POSTS_DIR), ("replies", REPLIES_DIR), ("questions", REPLY_QUESTION_DIR)):
+        if not os.path.isdir(source_dir):
+            continue
+        for filename in sorted(os.listdir(source_dir)):
+            if filename.endswith(".txt"):
+                yield f"{section}/{filename}", os.path.join(source_dir, filename)
+
+# 원본 파일 목록과 크기 (prepare_image의 미리 최적화된 이미지처럼 크기로 판단).
+# 수정 시각은 압축 도구와 압축 해제 방식에 따라 바뀌므로(zip_builder.py는 1980년으로 저장) 쓰지 않음
+def corpus_fingerprint():
+    return {key: os.path.getsize(path) for key, path in corpus_source_files()}
+
+# 팩이 지금의 원본 파일과 맞지 않으면 그 이유를, 맞으면 None을 반환 (파일마다 stat 한 번, 콜드 스타트에 한 번)
+def corpus_pack_stale_reason(pack):
+    if not pack.sources:
+        return "원본 정보가 없는 예전 형식의 팩"
+    if corpus_fingerprint() != pack.sources:
+        return "원본 파일 목록 또는 크기가 팩과 다름"
+    return None
+
+_corpus_pack = None
+
+# 웜 컨테이너에서는 한 번 연 mmap을 재사용. 팩이 없거나 오래되었으면 None (텍스트 파일을 직접 읽는 기존 방식 사용)
+def load_corpus_pack():
+    global _corpus_pack
+    if _corpus_pack is None:
+        _corpus_pack = False
+        if os.path.exists(CORPUS_PACK_FILE):
+            try:
+                pack = PackedCorpus(CORPUS_PACK_FILE)
+                stale = corpus_pack_stale_reason(pack)
+                if stale:
+                    pack.mm.close()
+                    print(f"[WARNING] 코퍼스 팩이 원본과 다름 → 텍스트 파일 사용 (zip_builder.py로 다시 만들어 주세요): {stale}")
+                else:
+                    _corpus_pack = pack
+                    print(f"[DEBUG] 코퍼스 팩 로드: {pack.sections}")
+            except (OSError, ValueError) as e:
+                print(f"[WARNING] 코퍼스 팩 읽기 실패 → 텍스트 파일 사용: {e}")
+    return _corpus_pack or None
+
 # 자동 포스트용 텍스트 로딩 (quotes/posts/)
 def load_random_work():
     print(f"[DEBUG] 랜덤 텍스트 로드 시도 - 폴더: {POSTS_DIR}")
@@ -161,33 +825,68 @@ def load_random_work():
     with open(os.path.join(POSTS_DIR, chosen_file), encoding="utf-8") as f:
         return chosen_file.replace(".txt", ""), f.read()
 
-# 자동 멘션 텍스트 응답 로딩 (quotes/replies/)
-def load_random_reply_chunk():
-    print(f"[DEBUG] 랜덤 답변 텍스트 청크 로드 시도 - 폴더: {REPLIES_DIR}")
-    files = [f for f in os.listdir(REPLIES_DIR) if f.endswith(".txt")]
-    print(f"[DEBUG] 텍스트 파일 목록: {files}")
+# 자동 멘션 응답용 코퍼스 캐시
+# - quotes/replies의 모든 파일을 청크 단위로 펼친 목록과 quotes/reply_images의 이미지 경로 목록을 프로세스 전역에 보관
+# - 폴더의 mtime이 바뀌었을 때만 다시 읽으므로, 웜 컨테이너에서는 응답할 때 파일 목록 조회나 파일 읽기를 하지 않음
+# - 파일이 아니라 청크 목록에서 뽑으므로 청크마다 같은 확률로 선택됨 (긴 파일의 청크가 불리하지 않음)
+REPLY_IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif")
 
-    if not files:
-        print("[WARNING] 텍스트 응답용 파일 없음")
+_reply_cache = {}
+
+def dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
         return None
 
-    chosen_file = random.choice(files)
-    with open(os.path.join(REPLIES_DIR, chosen_file), encoding="utf-8") as f:
-        content = f.read()
+# 캐시 키(key)에 대응하는 값을 폴더 mtime이 같으면 그대로, 다르면 loader로 새로 만들어 반환
+def cached_by_dir_mtime(key, path, loader):
+    mtime = dir_mtime(path)
+    cached = _reply_cache.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    value = loader() if mtime is not None else []
+    _reply_cache[key] = (mtime, value)
+    return value
+
+def read_reply_chunks():
+    print(f"[DEBUG] 답변 텍스트 청크 캐시 생성 - 폴더: {REPLIES_DIR}")
+    chunks = []
+    for filename in sorted(os.listdir(REPLIES_DIR)):
+        if not filename.endswith(".txt"):
+            continue
+        with open(os.path.join(REPLIES_DIR, filename), encoding="utf-8") as f:
+            content = f.read()
+
+        # 본문만 추출 (--- 구분선 기준)
+        parts = content.split('---')
+        if len(parts) < 2:
+            print(f"[WARNING] --- 구분선이 없어 본문만 사용 (파일 이름: {filename})")
+            main_text = content
+        else:
+            main_text = parts[1].strip()  # 본문만 추출
 
-    # 본문만 추출 (--- 구분선 기준)
-    parts = content.split('---')
-    if len(parts) < 2:
-        print("[WARNING] --- 구분선이 없어 본문만 사용")
-        main_text = content
-    else:
-        main_text = parts[1].strip()  # 본문만 추출
+        file_chunks = [chunk for chunk in split_into_chunks(main_text) if chunk]
+        if not file_chunks:
+            print(f"[WARNING] 청크 없음 (파일 이름: {filename})")
+        chunks.extend(file_chunks)
+    print(f"[DEBUG] 총 {len(chunks)}개 청크 캐시됨")
+    return chunks
 
-    chunks = split_into_chunks(main_text)
-    print(f"[DEBUG] 총 {len(chunks)}개 청크 추출됨")
+def read_reply_images():
+    return [os.path.join(REPLY_IMAGES_DIR, f) for f in sorted(os.listdir(REPLY_IMAGES_DIR)) if f.lower().endswith(REPLY_IMAGE_EXTS)]
+
+# 자동 멘션 텍스트 응답 로딩 (quotes/replies/)
+def load_random_reply_chunk():
+    pack = load_corpus_pack()
+    if pack and pack.count("replies"):
+        selected = pack.random("replies")
+        print(f"[DEBUG] 선택된 청크 (코퍼스 팩): {selected[:50]}...")
+        return selected
 
+    chunks = cached_by_dir_mtime("chunks", REPLIES_DIR, read_reply_chunks)
     if not chunks:
-        print(f"[WARNING] 청크 없음 (파일 이름: {chosen_file})")
+        print("[WARNING] 텍스트 응답용 파일 없음")
         return None
 
     selected = random.choice(chunks)
@@ -196,42 +895,63 @@ def load_random_reply_chunk():
 
 # 자동 멘션 이미지 응답 로딩 (quotes/reply_images/)
 def load_random_reply_image():
-    print(f"[DEBUG] 랜덤 답변 이미지 로드 시도 - 폴더: {REPLY_IMAGES_DIR}")
-    image_exts = (".jpg", ".jpeg", ".png", ".webp", ".gif")
-    files = [f for f in os.listdir(REPLY_IMAGES_DIR) if f.lower().endswith(image_exts)]
-    if not files:
+    images = cached_by_dir_mtime("images", REPLY_IMAGES_DIR, read_reply_images)
+    if not images:
         return None
-    return os.path.join(REPLY_IMAGES_DIR, random.choice(files))
+    return random.choice(images)
+
+# 질문 키워드 → 응답 파일 규칙. 위에 있는 규칙이 우선합니다.
+# 여러 개 추가 가능.
+QUESTION_RULES = OrderedDict([
+    (("키워드",), "대응 파일명.txt"),
+])
+
+# QUESTION_RULES를 import 시점에 한 번 컴파일.
+# 키워드는 소문자로 바꾸고 특수문자만 지움. 조사는 떼지 않음 (키워드 "포도"가 "포"가 되어 "포스트"에 걸리지 않도록)
+def question_keyword(kw):
+    return NORMALIZE_STRIP_PATTERN.sub("", kw).lower()
+
+def compile_question_rules(rules):
+    matcher = AhoCorasick()
+    for rule_index, (keywords, filename) in enumerate(rules.items()):
+        for kw_index, kw in enumerate(keywords):
+            matcher.add(question_keyword(kw), (rule_index, kw_index, kw, filename))
+    return matcher.build()
+
+QUESTION_MATCHER = compile_question_rules(QUESTION_RULES)
+
+# 정규화된 멘션(NormalizedText)의 단어마다 키워드를 찾아, 가장 우선순위가 높은 규칙의 (파일명, 원래 키워드, 일치한 단어) 반환
+# 키워드는 한 단어 안에서만 일치함 (단어 경계를 넘는 일치는 없음)
+def match_question_rule(normalized):
+    best = min(((value, word_index) for word_index, word in enumerate(normalized.words)
+                for _, _, value in QUESTION_MATCHER.iter_matches(word)), default=None)
+    if best is None:
+        return None
+    (_, _, kw, filename), word_index = best
+    return filename, kw, normalized.words[word_index]
 
-# 자동 멘션 질문 응답 로딩 (quotes/reply_images/)
+# 자동 멘션 질문 응답 로딩 (quotes/reply_questions/)
 def question_mention(mention_text, root_cid, root_uri, parent_cid, parent_uri, jwt, did):
     print(f"[DEBUG] question_mention() 호출됨 - 원본 텍스트: '{mention_text}'")
-    mention_text = normalize_text(mention_text)
-    mention_words = [strip_josa(w) for w in mention_text.split()]
-    matched_filename = None
-    print(f"[DEBUG] 정규화된 텍스트: '{mention_text}'")
-
-    # 여러 개 추가 가능.
-    QUESTION_RULES =  OrderedDict([
-        (("키워드",), "대응 파일명.txt"),
-    ])
-
-    for keywords, filename in QUESTION_RULES.items():
-        for word in mention_words:
-            for kw in keywords:
-                if any(kw == word or kw in word for word in mention_words for kw in keywords):
-                    matched_filename = filename
-                    print(f"[DEBUG] 키워드 매칭 성공: '{kw}' == '{word}' or in '{word}' → {filename}")
-                    break
-            if matched_filename:
-                break
-        if matched_filename:
-            break
+    normalized = normalize_mention(mention_text)
+    print(f"[DEBUG] 정규화된 텍스트: '{normalized.text}'")
 
-    if not matched_filename:
+    match = match_question_rule(normalized)
+    if not match:
         print("[DEBUG] 질문 키워드 매칭 실패")
         return "질문 내용이 명확하지 않아 응답할 수 없습니다."
 
+    matched_filename, kw, word = match
+    print(f"[DEBUG] 키워드 매칭 성공: '{kw}' in '{word}' → {matched_filename}")
+
+    pack = load_corpus_pack()
+    if pack:
+        content = pack.get_by_name("questions", matched_filename)
+        if content is None:
+            print(f"[WARNING] 질문 응답용 파일 없음 (코퍼스 팩): {matched_filename}")
+            return "해당 주제에 대한 응답 파일이 없습니다."
+        return question_reply_text(matched_filename, content)
+
     file_path = os.path.join(REPLY_QUESTION_DIR, matched_filename)
 
     # 디버깅: 현재 경로와 폴더 내용 출력
@@ -248,8 +968,10 @@ def question_mention(mention_text, root_cid, root_uri, parent_cid, parent_uri, j
         return "해당 주제에 대한 응답 파일이 없습니다."
 
     with open(file_path, encoding="utf-8") as f:
-        content = f.read().strip()
+        return question_reply_text(matched_filename, f.read())
 
+def question_reply_text(matched_filename, content):
+    content = content.strip()
     if not content:
         print(f"[WARNING] 질문 파일 내용 비어 있음: {matched_filename}")
         return "내용이 비어 있어 응답할 수 없습니다."
@@ -321,8 +1043,7 @@ def handle_mention(mention_text, root_cid, root_uri, parent_cid, parent_uri, jwt
         image_path = load_random_reply_image()
         if image_path and os.path.exists(image_path):
             try:
-                image_bytes, mime = compress_image(image_path)
-                blob = upload_blob(jwt, image_bytes, mime)
+                image = prepare_image(image_path)
                 post = {
                     "$type": "app.bsky.feed.post",
                     "text": "📷 요청하신 이미지를 첨부합니다.",
@@ -332,7 +1053,7 @@ def handle_mention(mention_text, root_cid, root_uri, parent_cid, parent_uri, jwt
                         "$type": "app.bsky.embed.images",
                         "images": [{
                             "alt": os.path.basename(image_path),
-                            "image": blob
+                            "image": None # create_image_post에서 blob으로 채움
                         }]
                     },
                     "reply": {
@@ -340,7 +1061,7 @@ def handle_mention(mention_text, root_cid, root_uri, parent_cid, parent_uri, jwt
                         "parent": {"cid": parent_cid, "uri": parent_uri}
                     }
                 }
-                create_record(jwt, did, "app.bsky.feed.post", post)
+                create_image_post(jwt, did, post, [image])
             except Exception as e:
                 print(f"[ERROR] 이미지 응답 실패: {e}")
 
@@ -376,55 +1097,342 @@ def handle_mention(mention_text, root_cid, root_uri, parent_cid, parent_uri, jwt
 OWNER_DID = os.environ.get("BLUESKY_DID")
 
 def remove_from_ignored_dids(target_did):
-    if not os.path.exists(IGNORED_DID_FILE):
-        return
-    with open(IGNORED_DID_FILE, "r", encoding="utf-8") as f:
-        lines = [line.strip() for line in f if line.strip() and line.strip() != target_did]
-    with open(IGNORED_DID_FILE, "w", encoding="utf-8") as f:
-        for line in lines:
-            f.write(line + "\n")
+    BLACKLIST.remove([target_did])
+
+def add_to_ignored_dids(dids):
+    BLACKLIST.add(dids)
+
+# 봇 상태 저장소 (SQLite, WAL 모드)
+# - 하루 멘션 횟수, 작성자별 멘션 텍스트 기록, 처리된 CID, 블랙리스트, NG/멘션 로그를 한 파일에서 관리
+# - 모든 조회는 PRIMARY KEY/인덱스를 사용하므로 기록이 쌓여도 전체 파일을 다시 읽지 않음
+# - 날짜가 바뀌면 지난 날짜의 카운터/텍스트 기록과 오래된 로그를 자동으로 정리
+# - 한 번의 실행에서 일어나는 쓰기는 batch()로 묶어 하나의 트랜잭션으로 커밋
+STATE_DB_FILE = "/tmp/bot_state.db"
+STATE_LOG_RETENTION_DAYS = 30
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS mention_counts (
+    day TEXT NOT NULL, did TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, did)
+);
+CREATE TABLE IF NOT EXISTS mention_texts (
+    day TEXT NOT NULL, did TEXT NOT NULL, text TEXT NOT NULL,
+    PRIMARY KEY (day, did, text)
+);
+CREATE TABLE IF NOT EXISTS processed_cids (cid TEXT PRIMARY KEY, processed_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_processed_cids_at ON processed_cids (processed_at);
+CREATE TABLE IF NOT EXISTS ignored_dids (did TEXT PRIMARY KEY, added_at TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS ng_log (
+    id INTEGER PRIMARY KEY, logged_at TEXT NOT NULL, day TEXT NOT NULL,
+    cid TEXT, author_did TEXT, keyword TEXT, message TEXT, text TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_ng_log_day ON ng_log (day);
+CREATE TABLE IF NOT EXISTS mention_log (
+    id INTEGER PRIMARY KEY, logged_at TEXT NOT NULL, day TEXT NOT NULL,
+    cid TEXT, author_did TEXT, text TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_mention_log_day ON mention_log (day);
+CREATE TABLE IF NOT EXISTS blob_refs (sha256 TEXT PRIMARY KEY, blob TEXT NOT NULL, registered_at TEXT NOT NULL);
+"""
+
+# 오늘 날짜(UTC)를 YYYY-MM-DD 형식으로 반환
+def today_utc():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+class StateStore:
+    def __init__(self, path=STATE_DB_FILE):
+        self.path = path
+        self.conn = None
+        self.pruned_day = None
+
+    # 처음 사용할 때 연결하고, 웜 컨테이너에서는 같은 연결을 재사용
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, isolation_level=None) # 트랜잭션은 batch()에서 직접 관리
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(STATE_SCHEMA)
+        return self.conn
+
+    def execute(self, sql, params=()):
+        return self.connect().execute(sql, params)
+
+    # 실행 한 번의 쓰기를 하나의 트랜잭션으로 묶음.
+    # 예외가 나더라도 그때까지 처리한 내용(이미 답글을 보낸 CID 등)은 커밋하여 중복 응답을 막음
+    @contextmanager
+    def batch(self):
+        conn = self.connect()
+        if conn.in_transaction:
+            yield self
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.prune_if_new_day()
+            yield self
+        finally:
+            conn.execute("COMMIT")
+
+    # 날짜가 바뀌었을 때만 지난 기록을 정리
+    def prune_if_new_day(self):
+        today = today_utc()
+        if self.pruned_day == today:
+            return
+        row = self.execute("SELECT value FROM meta WHERE key = 'pruned_day'").fetchone()
+        if not row or row[0] != today:
+            log_cutoff = (datetime.now(timezone.utc) - timedelta(days=STATE_LOG_RETENTION_DAYS)).strftime("%Y-%m-%d")
+            self.execute("DELETE FROM mention_counts WHERE day < ?", (today,))
+            self.execute("DELETE FROM mention_texts WHERE day < ?", (today,))
+            self.execute("DELETE FROM ng_log WHERE day < ?", (log_cutoff,))
+            self.execute("DELETE FROM mention_log WHERE day < ?", (log_cutoff,))
+            self.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pruned_day', ?)", (today,))
+            print(f"[DEBUG] 상태 저장소 날짜 변경 정리 완료: {today}")
+        self.pruned_day = today
+
+    # 변경 감지용 버전. 다른 연결(수동 편집 등)이 커밋하면 값이 바뀜
+    def data_version(self):
+        return self.execute("PRAGMA data_version").fetchone()[0]
+
+    # 하루 멘션 횟수
+    def load_mention_counts(self, day):
+        return dict(self.execute("SELECT did, count FROM mention_counts WHERE day = ?", (day,)))
+
+    def save_mention_counts(self, day, counts):
+        self.connect().executemany(
+            "INSERT OR REPLACE INTO mention_counts (day, did, count) VALUES (?, ?, ?)",
+            [(day, did, count) for did, count in counts.items()]
+        )
+
+    # 작성자별 멘션 텍스트 기록
+    def load_mention_texts(self, day):
+        texts = {}
+        for did, text in self.execute("SELECT did, text FROM mention_texts WHERE day = ?", (day,)):
+            texts.setdefault(did, set()).add(text)
+        return texts
+
+    def add_mention_texts(self, day, items):
+        self.connect().executemany(
+            "INSERT OR IGNORE INTO mention_texts (day, did, text) VALUES (?, ?, ?)",
+            [(day, did, text) for did, text in items]
+        )
+
+    # 처리된 CID
+    def load_processed_cids(self, since):
+        return dict(self.execute("SELECT cid, processed_at FROM processed_cids WHERE processed_at >= ?", (since,)))
+
+    def add_processed_cids(self, items):
+        self.connect().executemany("INSERT OR REPLACE INTO processed_cids (cid, processed_at) VALUES (?, ?)", items)
+
+    def prune_processed_cids(self, before):
+        return self.execute("DELETE FROM processed_cids WHERE processed_at < ?", (before,)).rowcount
+
+    # 블랙리스트
+    def load_ignored_dids(self):
+        return {row[0] for row in self.execute("SELECT did FROM ignored_dids")}
+
+    def add_ignored_dids(self, dids):
+        now = now_timestamp()
+        self.connect().executemany("INSERT OR IGNORE INTO ignored_dids (did, added_at) VALUES (?, ?)", [(d, now) for d in dids])
+
+    def remove_ignored_dids(self, dids):
+        self.connect().executemany("DELETE FROM ignored_dids WHERE did = ?", [(d,) for d in dids])
+
+    # NG/멘션 로그 (rows: (logged_at, day, cid, author_did, ...))
+    def add_ng_logs(self, rows):
+        self.connect().executemany(
+            "INSERT INTO ng_log (logged_at, day, cid, author_did, keyword, message, text) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
 
-# 하루에 질문 10회 제한
-MENTION_COUNT_FILE = "/tmp/mention_counts.json"
+    def add_mention_logs(self, rows):
+        self.connect().executemany(
+            "INSERT INTO mention_log (logged_at, day, cid, author_did, text) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+
+    # 업로드한 이미지 blob 참조 (이미지 내용의 SHA-256 → uploadBlob 응답의 blob)
+    def load_blob_ref(self, sha256):
+        row = self.execute("SELECT blob FROM blob_refs WHERE sha256 = ?", (sha256,)).fetchone()
+        return json.loads(row[0]) if row else None
 
-def track_mention_count(did):
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    data = {}
-    if os.path.exists(MENTION_COUNT_FILE):
-        with open(MENTION_COUNT_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    def add_blob_refs(self, items):
+        now = now_timestamp()
+        self.connect().executemany(
+            "INSERT OR REPLACE INTO blob_refs (sha256, blob, registered_at) VALUES (?, ?, ?)",
+            [(sha256, json.dumps(blob), now) for sha256, blob in items]
+        )
 
-    if today not in data:
-        data[today] = {}
+    def remove_blob_refs(self, hashes):
+        self.connect().executemany("DELETE FROM blob_refs WHERE sha256 = ?", [(h,) for h in hashes])
+
+STATE = StateStore()
+
+# 알림 폴링 설정
+# - 마지막으로 처리한 알림의 indexedAt(워터마크)을 저장해두고, 그보다 새로운 알림만 페이지를 넘기며 가져옴
+# - 서버 측에서 mention/reply 알림만 필터링하도록 reasons 파라미터 사용
+#   reply 알림은 봇을 직접 멘션한 답글만 처리 (봇의 스레드에 달린 일반 답글은 멘션 횟수·자동 응답 대상이 아님)
+# - 조용한 1분에는 작은 요청 1회로 끝나도록 첫 페이지는 작게 요청
+# - 알림이 몰리면 워터마크까지 페이지를 넘기고, 오래된 것부터 최대 NOTIFICATION_MAX_PER_RUN건만 처리.
+#   워터마크는 처리한 알림까지만 올리므로 나머지는 다음 실행에서 다시 가져와 이어서 처리됨
+# - 한 번에 넘기는 페이지는 NOTIFICATION_MAX_PAGES까지. 그 안에 워터마크에 닿지 못하면(장애 후 밀린 알림 등)
+#   도중의 커서를 상태 파일의 커서 스택에 쌓고, 다음 실행은 처음부터가 아니라 그 커서부터 더 오래된 쪽으로 이어서 내려감.
+#   가장 아래 구간을 다 처리하면 그 커서를 꺼내고, 바로 위 구간부터 이어서 처리 (어느 실행이든 요청은 페이지 상한 이내)
+#   커서는 상한보다 한 페이지 앞에서 쌓으므로, 위 구간을 다시 훑을 때도 워터마크에 닿는 페이지까지 상한 안에 들어옴
+NOTIFICATION_STATE_FILE = "/tmp/notification_state.json"
+MENTION_REASONS = ("mention", "reply")
+NOTIFICATION_FIRST_PAGE = 10
+NOTIFICATION_PAGE_SIZE = 50
+NOTIFICATION_MAX_PAGES = 10
+NOTIFICATION_MAX_PER_RUN = 100
+
+_notification_state = {}
+
+def load_notification_state():
+    if not _notification_state and os.path.exists(NOTIFICATION_STATE_FILE):
+        try:
+            with open(NOTIFICATION_STATE_FILE, "r", encoding="utf-8") as f:
+                _notification_state.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"[WARNING] 알림 상태 파일 읽기 실패 → 무시: {e}")
+    return _notification_state
+
+def write_notification_state():
+    try:
+        write_json_atomic(NOTIFICATION_STATE_FILE, _notification_state)
+    except OSError as e:
+        print(f"[WARNING] 알림 상태 파일 저장 실패: {e}")
 
-    data[today][did] = data[today].get(did, 0) + 1
+def save_notification_state(watermark):
+    _notification_state["watermark"] = watermark
+    write_notification_state()
 
-    with open(MENTION_COUNT_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f)
-    return data[today][did]
+# 밀린 알림을 이어서 내려갈 커서 스택 저장 (마지막 항목이 가장 오래된 구간의 시작)
+def save_notification_cursors(cursors):
+    if _notification_state.get("cursors", []) == cursors:
+        return
+    if cursors:
+        _notification_state["cursors"] = cursors
+    else:
+        _notification_state.pop("cursors", None)
+    write_notification_state()
+
+# 워터마크 이후의 mention/reply 알림만 모아 오래된 순서로 반환
+# cursor가 있으면 그 위치부터 내려감. (알림 목록, 다음에 이어서 내려갈 커서) 반환.
+# 페이지 상한 안에 워터마크에 닿지 못하면 더 오래된 알림이 남아 있으므로 알림 목록은 비우고,
+# 상한 한 페이지 앞의 커서를 돌려줌
+def fetch_new_notifications(jwt, watermark, cursor=None):
+    notifications = []
+    descend_cursor = None
+    # 워터마크가 없으면(콜드 스타트 후 첫 실행) 예전처럼 최신 한 페이지만 확인
+    limit = NOTIFICATION_FIRST_PAGE if watermark and not cursor else NOTIFICATION_PAGE_SIZE
+    page = 0
+
+    while True:
+        params = {"limit": limit, "reasons": list(MENTION_REASONS)}
+        if cursor:
+            params["cursor"] = cursor
+        res = XRPC.get("app.bsky.notification.listNotifications", jwt=jwt, params=params)
+        items = res.get("notifications", [])
+        page += 1
+        print(f"[DEBUG] 알림 페이지 {page}: {len(items)}건")
+
+        caught_up = False
+        for notif in items:
+            if watermark and notif.get("indexedAt", "") <= watermark:
+                caught_up = True
+                break
+            notifications.append(notif)
 
-# /tmp/mention_text_history.json 파일을 기반으로 오늘 같은 멘션을 이미 처리했는지 확인
-MENTION_TEXT_HISTORY_FILE = "/tmp/mention_text_history.json"
+        cursor = res.get("cursor")
+        if caught_up or not cursor or not items or not watermark:
+            break
+        if page == NOTIFICATION_MAX_PAGES - 1:
+            descend_cursor = cursor
+        if page >= NOTIFICATION_MAX_PAGES:
+            print(f"[WARNING] 알림 {page}페이지 안에 워터마크에 닿지 못함 → 다음 실행에서 더 오래된 알림부터 이어서 가져옵니다.")
+            return [], descend_cursor
+        limit = NOTIFICATION_PAGE_SIZE
+
+    notifications.reverse() # API는 최신순으로 반환하므로 오래된 것부터 처리
+    return notifications, None
+
+# 이번 실행에서 처리할 만큼만 잘라냄. indexedAt이 같은 알림이 잘리면 워터마크가 남은 것을 건너뛰므로 같은 시각까지는 함께 처리
+def limit_notifications(notifications, max_count=NOTIFICATION_MAX_PER_RUN):
+    if len(notifications) <= max_count:
+        return notifications
+    end = max_count
+    while end < len(notifications) and notifications[end].get("indexedAt") == notifications[end - 1].get("indexedAt"):
+        end += 1
+    print(f"[WARNING] 새 알림 {len(notifications)}건 중 오래된 {end}건만 처리하고, 나머지는 다음 실행에서 처리합니다.")
+    return notifications[:end]
+
+# 멘션 처리 한 번(process_mentions 1회)의 상태
+# - 시작할 때 오늘의 멘션 횟수/텍스트 기록, 처리된 CID, 블랙리스트, 워터마크를 한 번에 읽어오고
+# - 알림을 처리하는 동안에는 메모리에서만 수정한 뒤
+# - 끝날 때 flush()로 SQLite에는 하나의 트랜잭션으로, 워터마크 파일은 임시 파일 rename으로 한 번만 기록
+# 따라서 파일 I/O는 멘션 수와 관계없이 실행당 일정함
+class InvocationState:
+    def __init__(self, store=STATE):
+        self.store = store
+        self.day = today_utc()
+        self.counts = {}
+        self.texts = {}
+        self.changed_counts = set()
+        self.new_texts = []
+        self.ng_logs = []
+        self.mention_logs = []
+        self.watermark = None
+        self.saved_watermark = None
+
+    def load(self):
+        self.counts = self.store.load_mention_counts(self.day)
+        self.texts = self.store.load_mention_texts(self.day)
+        self.watermark = self.saved_watermark = load_notification_state().get("watermark")
+        PROCESSED_CIDS.load()
+        BLACKLIST.refresh()
+        return self
+
+    # 하루에 질문 10회 제한
+    def track_mention_count(self, did):
+        self.counts[did] = self.counts.get(did, 0) + 1
+        self.changed_counts.add(did)
+        return self.counts[did]
+
+    # 오늘 같은 작성자에게서 같은 멘션 텍스트를 이미 처리했는지 확인 (처음 보는 텍스트면 기록)
+    def is_duplicate_mention_text(self, did, text):
+        text = text.strip()
+        seen = self.texts.setdefault(did, set())
+        if text in seen:
+            return True  # 이미 동일한 텍스트가 처리됨
+        seen.add(text)
+        self.new_texts.append((did, text))
+        return False
 
-def is_duplicate_mention_text(did, text):
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    data = {}
-    if os.path.exists(MENTION_TEXT_HISTORY_FILE):
-        with open(MENTION_TEXT_HISTORY_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    def log_ng_mention(self, cid, author_did, keyword, message, text):
+        self.ng_logs.append((now_timestamp(), self.day, cid, author_did, keyword, message, text))
 
-    if today not in data:
-        data[today] = {}
+    def log_mention(self, cid, author_did, text):
+        self.mention_logs.append((now_timestamp(), self.day, cid, author_did, text))
 
-    if did in data[today] and text.strip() in data[today][did]:
-        return True  # 이미 동일한 텍스트가 처리됨
+    def advance_watermark(self, indexed_at):
+        self.watermark = max(self.watermark or "", indexed_at or "") or None
 
-    # 새 텍스트 추가
-    data[today].setdefault(did, []).append(text.strip())
-    with open(MENTION_TEXT_HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    def flush(self):
+        with self.store.batch():
+            self.store.save_mention_counts(self.day, {did: self.counts[did] for did in self.changed_counts})
+            self.store.add_mention_texts(self.day, self.new_texts)
+            self.store.add_ng_logs(self.ng_logs)
+            self.store.add_mention_logs(self.mention_logs)
+            PROCESSED_CIDS.flush()
+            BLACKLIST.flush()
+        self.changed_counts.clear()
+        self.new_texts.clear()
+        self.ng_logs.clear()
+        self.mention_logs.clear()
 
-    return False
+        if self.watermark and self.watermark != self.saved_watermark:
+            save_notification_state(self.watermark)
+            self.saved_watermark = self.watermark
 
 # 자동 맨션 기능
 def process_mentions(auth):
@@ -433,215 +1441,563 @@ def process_mentions(auth):
     jwt = auth["accessJwt"]
     did = auth["did"]
 
-    res = requests.get(
-        "https://bsky.social/xrpc/app.bsky.notification.listNotifications",
-        headers={"Authorization": f"Bearer {jwt}"},
-        params={"limit": 50}
+    notification_state = load_notification_state()
+    watermark = notification_state.get("watermark")
+    cursors = list(notification_state.get("cursors", []))
+    notifications, deeper_cursor = fetch_new_notifications(jwt, watermark, cursors[-1] if cursors else None)
+    if deeper_cursor:
+        save_notification_cursors(cursors + [deeper_cursor])
+        return
+    batch = limit_notifications(notifications)
+    # 이번 구간을 다 처리하면 커서를 꺼내 다음 실행은 바로 위 구간부터, 못 다 하면 같은 커서부터
+    if cursors and len(batch) == len(notifications):
+        save_notification_cursors(cursors[:-1])
+    if not notifications:
+        print("[DEBUG] 새 알림 없음")
+        return
+    notifications = batch
+
+    state = InvocationState().load()
+    # 처리가 끝난 알림까지만 워터마크를 올려, 중간에 실패해도 다음 실행에서 이어서 처리
+    try:
+        for notif in notifications:
+            handle_notification(notif, jwt, did, state)
+            state.advance_watermark(notif.get("indexedAt"))
+    finally:
+        state.flush()
+
+    XRPC.post("app.bsky.notification.updateSeen", jwt=jwt, json={"seenAt": now_timestamp()})
+
+# 게시물 레코드의 facets에 did를 가리키는 멘션이 있는지 확인
+def mentions_did(record, did):
+    return any(
+        feature.get("$type") == "app.bsky.richtext.facet#mention" and feature.get("did") == did
+        for facet in record.get("facets") or [] for feature in facet.get("features", [])
     )
-    res.raise_for_status()
-    notifications = res.json().get("notifications", [])
 
-    for notif in notifications:
-        print(f"[DEBUG] 알림 reason: {notif.get('reason')} | CID: {notif.get('cid')}")
-        if notif.get("reason") != "mention":
-            continue
+# 알림 한 건 처리
+def handle_notification(notif, jwt, did, state):
+    print(f"[DEBUG] 알림 reason: {notif.get('reason')} | CID: {notif.get('cid')}")
+    if notif.get("reason") not in MENTION_REASONS:
+        return
+    if notif.get("reason") == "reply" and not mentions_did(notif.get("record", {}), did):
+        print("[DEBUG] 봇을 멘션하지 않은 답글 → 무시")
+        return
 
-        cid = notif["cid"]
-        if is_already_processed(cid):
-            print(f"[INFO] 이미 처리된 멘션: {cid}")
-            continue
+    cid = notif["cid"]
+    if is_already_processed(cid):
+        print(f"[INFO] 이미 처리된 멘션: {cid}")
+        return
 
-        author = notif["author"]
-        author_did = author["did"]
-        uri = notif["uri"]
-        text = notif.get("record", {}).get("text", "")
+    author = notif["author"]
+    author_did = author["did"]
+    uri = notif["uri"]
+    record = notif.get("record", {})
+    text = record.get("text", "")
 
-        if is_duplicate_mention_text(author_did, text):
-            print(f"[INFO] 동일한 멘션 텍스트 반복 감지됨 → 무시: {text[:30]}...")
-            mark_cid_processed(cid)
-            continue
+    # 스레드 안의 멘션/답글이면 원래 스레드의 root를 유지해야 답글이 스레드에 붙음
+    thread_root = record.get("reply", {}).get("root") or {"cid": cid, "uri": uri}
+    root_cid, root_uri = thread_root["cid"], thread_root["uri"]
 
-        if is_ignored_did(author_did):
-            print(f"[INFO] 무시된 DID: {author_did}")
-            mark_cid_processed(cid)
-            continue
+    if state.is_duplicate_mention_text(author_did, text):
+        print(f"[INFO] 동일한 멘션 텍스트 반복 감지됨 → 무시: {text[:30]}...")
+        mark_cid_processed(cid)
+        return
 
-        ng_msg, ng_kw = check_ng_category(text)
-        if ng_msg:
-            log_ng_mention(cid, author_did, ng_kw, ng_msg, text)
-            add_to_ignored_dids([author_did])
-            handle_mention(text, cid, uri, cid, uri, jwt, did)
-            mark_cid_processed(cid)
-            continue
+    if is_ignored_did(author_did):
+        print(f"[INFO] 무시된 DID: {author_did}")
+        mark_cid_processed(cid)
+        return
 
-        if author_did == OWNER_DID and "블랙리스트 해제" in text:
-            # 해제할 대상 추출 (예: "@wonguobot 블랙리스트 해제 @did:plc:xxxx")
-                match = re.search(r"@([a-zA-Z0-9_.:-]+)", text)
-                if match:
-                    target_did = match.group(1)
-                    remove_from_ignored_dids(target_did)
-                    print(f"[INFO] 블랙리스트 해제됨: {target_did}")
-
-                    # 블랙리스트 해제 알림 멘션도 여기서 함께 처리
-                    if jwt and did:
-                        post = {
-                            "$type": "app.bsky.feed.post",
-                            "text": f"✅ @{target_did} 블랙리스트에서 해제되었습니다.",
-                            "createdAt": now_timestamp(),
-                            "langs": ["ko"]
-                        }
-                        create_record(jwt, did, "app.bsky.feed.post", post)
-                else:
-                    print("[WARNING] 블랙리스트 해제 명령어는 있지만 대상 DID를 찾지 못함.")
-                create_record(jwt, did, "app.bsky.feed.post", post)
+    ng_msg, ng_kw = check_ng_category(text)
+    if ng_msg:
+        state.log_ng_mention(cid, author_did, ng_kw, ng_msg, text)
+        add_to_ignored_dids([author_did])
+        handle_mention(text, root_cid, root_uri, cid, uri, jwt, did)
+        mark_cid_processed(cid)
+        return
 
-        count = track_mention_count(author_did)
-        if count > 10:
-            print(f"[INFO] {author_did} - 하루 멘션 {count}회 초과 → 무시 목록 등록")
-            add_to_ignored_dids([author_did])
-            mark_cid_processed(cid)
-            continue
+    if author_did == OWNER_DID and "블랙리스트 해제" in text:
+        # 해제할 대상 추출 (예: "@wonguobot 블랙리스트 해제 @did:plc:xxxx")
+            match = re.search(r"@([a-zA-Z0-9_.:-]+)", text)
+            if match:
+                target_did = match.group(1)
+                remove_from_ignored_dids(target_did)
+                print(f"[INFO] 블랙리스트 해제됨: {target_did}")
+
+                # 블랙리스트 해제 알림 멘션도 여기서 함께 처리
+                if jwt and did:
+                    post = {
+                        "$type": "app.bsky.feed.post",
+                        "text": f"✅ @{target_did} 블랙리스트에서 해제되었습니다.",
+                        "createdAt": now_timestamp(),
+                        "langs": ["ko"]
+                    }
+                    create_record(jwt, did, "app.bsky.feed.post", post)
+            else:
+                print("[WARNING] 블랙리스트 해제 명령어는 있지만 대상 DID를 찾지 못함.")
+            create_record(jwt, did, "app.bsky.feed.post", post)
 
-        log_mention(cid, author_did, text)
-        handle_mention(text, cid, uri, cid, uri, jwt, did)
+    count = state.track_mention_count(author_did)
+    if count > 10:
+        print(f"[INFO] {author_did} - 하루 멘션 {count}회 초과 → 무시 목록 등록")
+        add_to_ignored_dids([author_did])
         mark_cid_processed(cid)
-        print(f"[DEBUG] 멘션 응답 완료: {cid} ({author['handle']})")
+        return
+
+    state.log_mention(cid, author_did, text)
+    handle_mention(text, root_cid, root_uri, cid, uri, jwt, did)
+    mark_cid_processed(cid)
+    print(f"[DEBUG] 멘션 응답 완료: {cid} ({author['handle']})")
 
 # 텍스트에서 이미지 파일명을 추출하여 텍스트/이미지 블록으로 분리
+# 블록을 다 모아 리스트로 만들지 않고 하나씩 넘김 (줄 단위 iterable도 받음)
+IMAGE_LINE_PATTERN = re.compile(r'^(.*\.(jpg|jpeg|png|gif|webp))$', re.IGNORECASE) # 이미지 파일 확장자 패턴
+
 def split_lines_with_images(text):
     print("[DEBUG] 텍스트 내 이미지 블록 추출 시작")
-    image_pattern = r'^(.*\.(jpg|jpeg|png|gif|webp))$' # 이미지 파일 확장자 패턴
-    lines = text.splitlines() # 텍스트를 줄 단위로 나눔
-    blocks = [] # 최종적으로 반환할 블록 리스트
-    buffer = "" # 텍스트를 임시로 저장할 버퍼
+    lines = text.splitlines() if isinstance(text, str) else text # 텍스트를 줄 단위로 나눔
+    buffer = [] # 텍스트 줄을 임시로 저장할 버퍼
 
     # 각 줄을 순차적으로 처리
     for line in lines:
         line = line.strip() # 줄 앞뒤 공백 제거
         if not line: # 빈 줄은 무시
             continue
-        if re.match(image_pattern, line, re.IGNORECASE): # 이미지 파일명인 경우
-            if buffer.strip(): # 이전에 저장된 텍스트가 있다면
-                blocks.append({"type": "text", "content": buffer.strip()}) # 이전 텍스트 블록 추가
-                buffer = "" # 텍스트 블록을 추가 후 버퍼 초기화
-            blocks.append({"type": "image", "filename": line})  # 이미지 블록 추가
+        if IMAGE_LINE_PATTERN.match(line): # 이미지 파일명인 경우
+            if buffer: # 이전에 저장된 텍스트가 있다면 텍스트 블록으로 넘기고 버퍼 초기화
+                yield {"type": "text", "content": "\n".join(buffer)}
+                buffer = []
+            yield {"type": "image", "filename": line} # 이미지 블록
         else:
-            buffer += line + "\n" # 텍스트는 계속해서 버퍼에 저장
-    if buffer.strip(): # 텍스트가 남아 있다면 블록에 추가
-        blocks.append({"type": "text", "content": buffer.strip()}) # 마지막 텍스트 블록 추가
-    return blocks
-
-# 300자를 초과하지 않도록 텍스트를 블록 단위로 분할
-def split_into_chunks(text, max_length=300):
-    lines = text.splitlines()
-    chunks = []
-    chunk = ""
-    for line in lines:
-        if len(chunk) + len(line) + 1 <= max_length: # 텍스트가 max_length 이하인 경우
-            chunk += line + "\n" 
+            buffer.append(line) # 텍스트는 계속해서 버퍼에 저장
+    if buffer: # 텍스트가 남아 있다면 마지막 텍스트 블록으로 넘김
+        yield {"type": "text", "content": "\n".join(buffer)}
+
+# Bluesky 포스트 길이 제한
+# 서버는 글자 수를 코드 포인트(len)가 아니라 확장 자소 클러스터(이모지 ZWJ 시퀀스, 국기, 결합 문자, 한글 자모 조합을 한 글자로)로 세고,
+# UTF-8 바이트 수도 따로 제한함. 둘 중 하나라도 넘으면 create_record가 400으로 실패.
+POST_MAX_GRAPHEMES = 300
+POST_MAX_BYTES = 3000
+
+# 자소 클러스터 경계 판단이 필요 없는 문자만으로 된 텍스트인지 확인하는 패턴 (대부분의 한국어/영어 텍스트는 len()으로 바로 계산)
+# ASCII, 라틴-1~IPA, 일반 구두점, CJK 기호(결합 성조 부호 제외), 가나(결합 탁점 제외), 호환 자모, 한자, 완성형 한글, 전각 문자(반각 탁점 제외)
+# 허용 문자의 반복을 fullmatch로 확인 (허용되지 않는 문자를 search로 찾는 것보다 약 2배 빠름)
+SIMPLE_TEXT_PATTERN = re.compile(
+    r"[\x00-\x7f\u00a0-\u02ff\u2010-\u2027\u2030-\u205e\u3000-\u3029\u3030-\u303f"
+    r"\u3040-\u3098\u309b-\u30ff\u3130-\u318f\u4e00-\u9fff\uac00-\ud7a3\uff00-\uff9d\uffa0-\uffef]*"
+)
+
+def is_simple_text(text):
+    return SIMPLE_TEXT_PATTERN.fullmatch(text) is not None
+
+# 한글 자모 종류 (L: 초성, V: 중성, T: 종성, LV/LVT: 완성형 음절)
+def hangul_jamo_type(cp):
+    if 0x1100 <= cp <= 0x115F or 0xA960 <= cp <= 0xA97C:
+        return "L"
+    if 0x1160 <= cp <= 0x11A7 or 0xD7B0 <= cp <= 0xD7C6:
+        return "V"
+    if 0x11A8 <= cp <= 0x11FF or 0xD7CB <= cp <= 0xD7FB:
+        return "T"
+    if 0xAC00 <= cp <= 0xD7A3:
+        return "LV" if (cp - 0xAC00) % 28 == 0 else "LVT"
+    return None
+
+HANGUL_JOINS = {
+    "L": ("L", "V", "LV", "LVT"),
+    "LV": ("V", "T"), "V": ("V", "T"),
+    "LVT": ("T",), "T": ("T",)
+}
+
+# 앞 글자에 붙는 문자 (결합 문자, ZWJ, 이형 선택자, 이모지 피부색, 태그 문자)
+def is_grapheme_extend(ch, cp):
+    if cp == 0x200D or 0xFE00 <= cp <= 0xFE0F or 0x1F3FB <= cp <= 0x1F3FF:
+        return True
+    if 0xE0020 <= cp <= 0xE007F or 0xE0100 <= cp <= 0xE01EF or 0xFF9E <= cp <= 0xFF9F:
+        return True
+    return unicodedata.category(ch) in ("Mn", "Me", "Mc")
+
+# ZWJ 뒤에 붙어 하나의 이모지가 되는 그림 문자 (Extended_Pictographic의 근사)
+def is_pictographic(ch, cp):
+    if 0x1F000 <= cp <= 0x1FAFF or 0x2600 <= cp <= 0x27BF:
+        return True
+    return unicodedata.category(ch) == "So"
+
+# 텍스트를 확장 자소 클러스터 단위로 나눔 (UAX #29 규칙 중 포스트 텍스트에 실제로 나오는 것들을 구현)
+def iter_graphemes(text):
+    cluster = []
+    prev_cp = None
+    prev_jamo = None
+    regional_run = 0 # 연속된 지역 표시 문자(국기) 개수
+    emoji_zwj = False # 현재 클러스터가 그림 문자(+결합 문자)로 시작해 ZWJ로 끝났는지
+    emoji_base = False # 현재 클러스터가 그림 문자 + 결합 문자로만 이어지고 있는지
+    for ch in text:
+        cp = ord(ch)
+        jamo = hangul_jamo_type(cp)
+        regional = 0x1F1E6 <= cp <= 0x1F1FF
+        if prev_cp is None:
+            join = False
+        elif prev_cp == 0x0D and cp == 0x0A: # CR LF
+            join = True
+        elif prev_cp in (0x0A, 0x0D):
+            join = False
+        elif is_grapheme_extend(ch, cp):
+            join = True
+        elif emoji_zwj and is_pictographic(ch, cp):
+            join = True
+        elif prev_jamo and jamo in HANGUL_JOINS[prev_jamo]:
+            join = True
+        elif regional and regional_run % 2 == 1:
+            join = True
         else:
-            chunks.append(chunk.strip()) # 현재 블록을 chunks에 추가
-            chunk = line + "\n" # 새로운 블록 시작
-    if chunk:
-        chunks.append(chunk.strip())  # 마지막 블록 추가
-    return chunks
+            join = False
+
+        if not join and cluster:
+            yield "".join(cluster)
+            cluster = []
+        cluster.append(ch)
+        regional_run = regional_run + 1 if regional else 0
+        if not join:
+            emoji_base = is_pictographic(ch, cp)
+        elif not emoji_zwj and not is_grapheme_extend(ch, cp):
+            emoji_base = False
+        emoji_zwj = emoji_base and cp == 0x200D
+        prev_cp = cp
+        prev_jamo = jamo
+    if cluster:
+        yield "".join(cluster)
+
+# Bluesky 기준 글자 수
+def grapheme_len(text):
+    if is_simple_text(text):
+        return len(text) - text.count("\r\n")
+    return sum(1 for _ in iter_graphemes(text))
+
+# (글자 수, 바이트 수). ASCII만 있으면 자소 계산 생략
+def measure_text(text):
+    size = len(text.encode("utf-8"))
+    if size == len(text):
+        return size - text.count("\r\n"), size
+    return grapheme_len(text), size
+
+def fits_post_limits(text, max_length=POST_MAX_GRAPHEMES, max_bytes=POST_MAX_BYTES):
+    # 바이트 수가 글자 수 제한보다 작으면 자소 계산 없이 통과 (UTF-8에서 글자 하나는 최소 1바이트)
+    size = len(text.encode("utf-8"))
+    if size > max_bytes:
+        return False
+    return size <= max_length or grapheme_len(text) <= max_length
+
+# 한 줄이 너무 길 때 나눌 위치: 문장 끝(마침표/물음표/느낌표/말줄임표 뒤 공백), 그다음은 단어 사이 공백
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"(?<=[.!?。！？…~])\s+")
+WORD_BOUNDARY_PATTERN = re.compile(r"\s+")
+
+# 제한을 넘는 한 줄을 문장 → 단어 → 글자 순으로 잘라 제한 안에 들어가는 조각 리스트로 반환
+def split_long_line(line, max_length, max_bytes):
+    if fits_post_limits(line, max_length, max_bytes):
+        return [line]
+    for pattern in (SENTENCE_BOUNDARY_PATTERN, WORD_BOUNDARY_PATTERN):
+        units = [unit for unit in pattern.split(line) if unit]
+        if len(units) > 1:
+            return pack_units(units, " ", max_length, max_bytes)
+
+    # 공백 없이 긴 문자열(URL 등)은 자소 단위로 자름
+    pieces = []
+    buffer = []
+    length = size = 0
+    for grapheme in iter_graphemes(line):
+        grapheme_size = len(grapheme.encode("utf-8"))
+        if buffer and (length + 1 > max_length or size + grapheme_size > max_bytes):
+            pieces.append("".join(buffer))
+            buffer = []
+            length = size = 0
+        buffer.append(grapheme)
+        length += 1
+        size += grapheme_size
+    if buffer:
+        pieces.append("".join(buffer))
+    return pieces
+
+# 조각들을 구분자로 이어 붙이되, 제한을 넘기 전에 새 묶음을 시작 (조각 자체가 길면 다시 잘게 나눔)
+def pack_units(units, separator, max_length, max_bytes):
+    packed = []
+    buffer = []
+    length = size = 0
+    separator_length, separator_size = measure_text(separator)
+    for unit in units:
+        unit_length, unit_size = measure_text(unit)
+        if unit_length <= max_length and unit_size <= max_bytes:
+            pieces = ((unit, unit_length, unit_size),)
+        else:
+            pieces = [(piece,) + measure_text(piece) for piece in split_long_line(unit, max_length, max_bytes)]
+        for piece, piece_length, piece_size in pieces:
+            if buffer and (length + separator_length + piece_length > max_length
+                           or size + separator_size + piece_size > max_bytes):
+                packed.append(separator.join(buffer))
+                buffer = []
+                length = size = 0
+            if buffer:
+                length += separator_length
+                size += separator_size
+            buffer.append(piece)
+            length += piece_length
+            size += piece_size
+    if buffer:
+        packed.append(separator.join(buffer))
+    return packed
+
+# 자소 계산이 필요 없는 텍스트의 줄 묶기. 글자 수 = len()이므로 줄마다 측정 함수를 부르지 않고 바로 셈
+# (BMP 문자는 UTF-8로 최대 3바이트라 max_bytes >= 3 * max_length이면 바이트 제한에도 걸리지 않음)
+def pack_simple_lines(lines, max_length, max_bytes):
+    # 제한을 넘는 줄은 드물기 때문에, 있을 때만 미리 조각으로 펼쳐 두고 아래 반복문은 줄 길이만 셈
+    if lines and max(map(len, lines)) > max_length:
+        lines = [piece for line in lines
+                 for piece in ((line,) if len(line) <= max_length else split_long_line(line, max_length, max_bytes))]
+    packed = []
+    buffer = []
+    length = -1 # 첫 줄 앞에는 구분자("\n")가 없으므로 -1에서 시작
+    for line in lines:
+        length += 1 + len(line)
+        if length > max_length and buffer:
+            packed.append("\n".join(buffer))
+            buffer = []
+            length = len(line)
+        buffer.append(line)
+    if buffer:
+        packed.append("\n".join(buffer))
+    return packed
+
+# 텍스트를 Bluesky 제한(300자, 3000바이트)을 넘지 않는 블록으로 분할
+# 줄 단위로 묶고, 한 줄이 제한을 넘으면 문장/단어 경계에서 나눔. 빈 청크는 반환하지 않음
+def split_into_chunks(text, max_length=POST_MAX_GRAPHEMES, max_bytes=POST_MAX_BYTES):
+    if max_bytes >= 3 * max_length and is_simple_text(text):
+        packed = pack_simple_lines(text.splitlines(), max_length, max_bytes)
+    else:
+        packed = pack_units(text.splitlines(), "\n", max_length, max_bytes)
+    chunks = [chunk.strip() for chunk in packed]
+    return [chunk for chunk in chunks if chunk]
 
 # 이 줄부터 메인 실행 함수 - 텍스트 로드, 이미지 업로드, 게시물 생성까지 전체 수행
 
 # 블루스카이 핸들 하이퍼링크 감지 기능 (+ DID 자동 변환)
+# - 변환 결과는 LRU+TTL 캐시(프로세스 전역)에 두어 웜 컨테이너에서는 같은 핸들을 다시 조회하지 않음
+# - 청크 하나에 든 핸들들은 스레드 풀에서 동시에 조회하고, 이미 조회 중인 핸들은 그 결과를 같이 기다림
+# - 존재하지 않는 핸들(400 응답)은 짧은 TTL로 캐시, 네트워크 오류는 캐시하지 않음
+HANDLE_CACHE_SIZE = 512
+HANDLE_CACHE_TTL = 6 * 60 * 60 # 6시간
+HANDLE_CACHE_NEGATIVE_TTL = 10 * 60 # 10분
+HANDLE_RESOLVE_WORKERS = 4
+
+class HandleResolver:
+    def __init__(self, max_size=HANDLE_CACHE_SIZE, ttl=HANDLE_CACHE_TTL,
+                 negative_ttl=HANDLE_CACHE_NEGATIVE_TTL, workers=HANDLE_RESOLVE_WORKERS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.workers = workers
+        self.cache = OrderedDict() # handle → (did 또는 None, 만료 시각)
+        self.pending = {} # 조회 중인 handle → Future
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def cached(self, handle, now):
+        item = self.cache.get(handle)
+        if item is None:
+            return False, None
+        if item[1] <= now:
+            del self.cache[handle]
+            return False, None
+        self.cache.move_to_end(handle)
+        return True, item[0]
+
+    def store(self, handle, did, ttl):
+        with self.lock:
+            self.cache[handle] = (did, time.time() + ttl)
+            self.cache.move_to_end(handle)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def fetch(self, handle):
+        try:
+            res = XRPC.get("com.atproto.identity.resolveHandle", params={"handle": handle})
+            self.store(handle, res["did"], self.ttl)
+            return res["did"]
+        except requests.exceptions.HTTPError as e:
+            print(f"[ERROR] DID resolve 실패: {handle} ({e})")
+            if e.response is not None and e.response.status_code == 400:
+                self.store(handle, None, self.negative_ttl)
+            return None
+        except Exception as e:
+            print(f"[ERROR] DID resolve 실패: {handle} ({e})")
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(handle, None)
+
+    # 핸들 목록을 한꺼번에 변환해 {handle: did 또는 None}으로 반환
+    def resolve_many(self, handles):
+        results = {}
+        futures = {}
+        now = time.time()
+        with self.lock:
+            for handle in dict.fromkeys(h.lower() for h in handles):
+                hit, did = self.cached(handle, now)
+                if hit:
+                    results[handle] = did
+                elif handle in self.pending:
+                    futures[handle] = self.pending[handle]
+                else:
+                    if self.executor is None:
+                        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="resolve")
+                    futures[handle] = self.pending[handle] = self.executor.submit(self.fetch, handle)
+        for handle, future in futures.items():
+            results[handle] = future.result()
+        return results
+
+    def resolve(self, handle):
+        return self.resolve_many([handle])[handle.lower()]
+
+HANDLE_RESOLVER = HandleResolver()
+
 def resolve_handle_to_did(handle):
-    try:
-        res = requests.get(
-            "https://bsky.social/xrpc/com.atproto.identity.resolveHandle",
-            params={"handle": handle}
-        )
-        res.raise_for_status()
-        print(f"[DEBUG] 알림 수신됨: {len(notifications)}건")
-        return res.json()["did"]
-    except Exception as e:
-        print(f"[ERROR] DID resolve 실패: {handle} ({e})")
+    return HANDLE_RESOLVER.resolve(handle)
+
+URL_PATTERN = re.compile(r'(https?://[^\s\)\]\}\<\>\"\']+)')
+# 핸들: 점으로 구분된 도메인 (xxx.bsky.social뿐 아니라 커스텀 도메인 핸들도 포함). 이메일 주소의 @는 제외
+HANDLE_PATTERN = r'(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?'
+MENTION_PATTERN = re.compile(r'(?<![a-zA-Z0-9_.@-])@(' + HANDLE_PATTERN + r')(?![a-zA-Z0-9-])')
+
+# facets 토크나이저: URL, 멘션, 해시태그를 한 번의 탐색으로 찾음
+# - 앞에 있는 대안이 우선이라 URL 안의 @핸들이나 #앵커는 따로 잡히지 않음
+# - 원문 그대로 검사하므로 바이트 위치가 실제 게시되는 텍스트와 일치함
+#   (예전에는 NBSP/전각 공백을 공백으로, '：'를 ':'로 바꾼 사본에서 위치를 계산해 그 뒤의 facets가 밀렸음)
+# - 해시태그는 줄 처음이나 공백 뒤의 #/＃로 시작하고, 끝의 문장 부호는 태그에서 뺌
+FACET_PATTERN = re.compile(
+    r'(?=[h@#＃])' # 후보 위치를 첫 글자로 먼저 걸러 탐색 속도를 높임
+    r'(?:(?P<link>https?[:：]//[^\s\u200B\)\]\}\<\>\"\']+)'
+    r'|(?<![a-zA-Z0-9_.@-])@(?P<mention>' + HANDLE_PATTERN + r')(?![a-zA-Z0-9-])'
+    r'|(?<!\S)[#＃](?P<tag>[^\s\u200B#＃]+))'
+)
+TAG_MAX_LENGTH = 64
+
+# 태그 끝의 문장 부호를 떼고, 숫자만 있거나 너무 긴 태그는 None
+def clean_hashtag(tag):
+    end = len(tag)
+    while end and unicodedata.category(tag[end - 1]).startswith("P"):
+        end -= 1
+    tag = tag[:end]
+    if not tag or tag.isdigit() or len(tag) > TAG_MAX_LENGTH:
         return None
+    return tag
 
-# URL을 감지하여 Bluesky API에서 하이퍼링크 미리보기(facets)를 붙일 수 있도록 구조화된 리스트로 반환
-def extract_facets(text):
+# URL, 멘션, 해시태그를 감지하여 Bluesky API에서 하이퍼링크/멘션/태그(facets)를 붙일 수 있도록 구조화된 리스트로 반환
+# resolve_mentions=False이면 네트워크가 필요한 핸들 → DID 변환은 건너뜀 (빌드 시 코퍼스 인덱스 생성용)
+def extract_facets(text, resolve_mentions=True):
     print("[DEBUG] extract_facets 시작")
     facets = []
-    text = re.sub(r'[\u00A0\u2000-\u200B\u202F\u205F\u3000]', ' ', text)
-    text = text.replace('：', ':')
-
-    # URL 감지
-    print("[DEBUG] URL 패턴 검사 시작")
-    url_pattern = r'(https?://[^\s\)\]\}\<\>\"\']+)'
-    for match in re.finditer(url_pattern, text):
-        url = match.group(0)
-        byte_start = len(text[:match.start()].encode("utf-8"))
-        byte_end = len(text[:match.end()].encode("utf-8"))
-        facets.append({
-            "index": {"byteStart": byte_start, "byteEnd": byte_end},
-            "features": [{"$type": "app.bsky.richtext.facet#link", "uri": url}]
-        })
-        print(f"[DEBUG] URL 감지됨: {url} (byteStart={byte_start}, byteEnd={byte_end})")
-
-    # 핸들 감지 및 DID 자동 변환
-    print("[DEBUG] 핸들 패턴 검사 시작")
-    mention_pattern = r'@([a-zA-Z0-9_.-]+\.bsky\.social)'
-    for match in re.finditer(mention_pattern, text):
-        handle = match.group(1)
-        did = resolve_handle_to_did(handle)
-        if not did:
-            print(f"[WARNING] DID resolve 실패: {handle}")
-            continue
-        byte_start = len(text[:match.start()].encode("utf-8"))
-        byte_end = len(text[:match.end()].encode("utf-8"))
+    matches = [
+        match for match in FACET_PATTERN.finditer(text)
+        if resolve_mentions or match.lastgroup != "mention"
+    ]
+    # 청크 안의 핸들은 한꺼번에 (동시에) DID로 변환
+    handles = [match.group("mention") for match in matches if match.lastgroup == "mention"]
+    dids = HANDLE_RESOLVER.resolve_many(handles) if handles else {}
+
+    # 바이트 위치는 직전 매치 위치부터 이어서 계산 (매치마다 앞부분 전체를 다시 인코딩하지 않음)
+    char_pos = byte_pos = 0
+    for match in matches:
+        kind = match.lastgroup
+        if kind == "link":
+            feature = {"$type": "app.bsky.richtext.facet#link", "uri": match.group("link").replace("：", ":")}
+            start, end = match.span()
+        elif kind == "mention":
+            handle = match.group("mention")
+            did = dids.get(handle.lower())
+            if not did:
+                print(f"[WARNING] DID resolve 실패: {handle}")
+                continue
+            feature = {"$type": "app.bsky.richtext.facet#mention", "did": did}
+            start, end = match.span()
+        else:
+            tag = clean_hashtag(match.group("tag"))
+            if not tag:
+                continue
+            feature = {"$type": "app.bsky.richtext.facet#tag", "tag": tag}
+            start = match.start()
+            end = match.start("tag") + len(tag)
+
+        byte_start = byte_pos + len(text[char_pos:start].encode("utf-8"))
+        byte_end = byte_start + len(text[start:end].encode("utf-8"))
+        char_pos, byte_pos = end, byte_end
         facets.append({
             "index": {"byteStart": byte_start, "byteEnd": byte_end},
-            "features": [{
-                "$type": "app.bsky.richtext.facet#mention",
-                "did": did
-            }]
+            "features": [feature]
         })
-        print(f"[DEBUG] 멘션 감지됨: @{handle} (DID: {did}, byteStart={byte_start}, byteEnd={byte_end})")
+        print(f"[DEBUG] {kind} 감지됨: {text[start:end]} (byteStart={byte_start}, byteEnd={byte_end})")
 
     if facets:
         print(f"[DEBUG] 총 facets 생성됨: {len(facets)}개")
     else:
-        print("[DEBUG] facets 없음 (URL/멘션 미감지)")
+        print("[DEBUG] facets 없음 (URL/멘션/태그 미감지)")
     return facets
 
 
 # 2. 자동 멘션 응답 키워드 분기
-def classify_request(text):
-    original_text = text  # 원본 보존
-    text = normalize_text(text)
-
-    print(f"[DEBUG] normalize_text 결과: '{text}'") 
-
-    image_keywords = ["이미지", "그림", "사진"]
-    text_keywords = ["스크립트", "ss", "텍스트"]
-    question_keywords  = [
-    "질문", "궁금", "알려줘", "알려", "뭐야", "무엇", "뭐지",
-    "말해줘", "말해봐", "말해", "소개해줘", "소개", "얘기해줘", "얘기해", "이야기해줘", "이야기해"
-    ]
+# 요청 종류별 키워드. 위에 있는 종류가 우선하며, 두 종류 이상이 동시에 감지되면 ambiguous로 처리.
+# 환경 변수 REQUEST_KEYWORDS_FILE에 {"reply_image": ["이미지", ...], ...} 형식의 JSON 파일 경로를 지정하면 그 내용을 사용.
+REQUEST_KEYWORDS_FILE_ENV = "REQUEST_KEYWORDS_FILE"
+DEFAULT_REQUEST_KEYWORDS = OrderedDict([
+    ("reply_image", ["이미지", "그림", "사진"]),
+    ("reply_text", ["스크립트", "ss", "텍스트"]),
+    ("reply_question", [
+        "질문", "궁금", "알려줘", "알려", "뭐야", "무엇", "뭐지",
+        "말해줘", "말해봐", "말해", "소개해줘", "소개", "얘기해줘", "얘기해", "이야기해줘", "이야기해"
+    ]),
+])
+
+def load_request_keywords():
+    path = os.environ.get(REQUEST_KEYWORDS_FILE_ENV)
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return OrderedDict(json.load(f, object_pairs_hook=OrderedDict))
+        except (OSError, ValueError) as e:
+            print(f"[WARNING] 요청 키워드 파일 읽기 실패 → 기본값 사용: {e}")
+    return DEFAULT_REQUEST_KEYWORDS
+
+# 종류마다 키워드를 하나의 정규식(alternation)으로 import 시점에 컴파일하고, 종류마다 search 한 번으로 확인.
+# 종류별로 따로 찾으므로 서로 겹친 키워드("사진"과 "사진첩")도 종류마다 빠짐없이 감지됨.
+# 키워드는 멘션과 같이 소문자로 바꾸고 특수문자를 지움 (설정 파일의 "Photo", "이미지 보여" 등도 그대로 동작)
+def request_keyword(kw):
+    return " ".join(question_keyword(kw).split())
+
+def compile_request_keywords(families):
+    patterns = []
+    for family, keywords in families.items():
+        keys = [re.escape(key) for key in dict.fromkeys(request_keyword(kw) for kw in keywords) if key]
+        if keys:
+            patterns.append((family, re.compile("|".join(keys))))
+    return patterns
+
+REQUEST_KEYWORDS = load_request_keywords()
+REQUEST_PATTERNS = compile_request_keywords(REQUEST_KEYWORDS)
+
+# 정규화된 멘션(NormalizedText)에서 감지된 요청 종류의 집합을 반환.
+# 공백 없는 키워드는 정규화된 텍스트에서 찾아도 한 단어 안에서만 일치하고, 공백 있는 키워드는 단어를 이어서 일치함
+def find_request_families(normalized):
+    return {family for family, pattern in REQUEST_PATTERNS if pattern.search(normalized.text)}
 
-    has_image_kw = any(k in text for k in image_keywords)
-    has_text_kw = any(k in text for k in text_keywords)
-    has_question_kw = any(k in text for k in question_keywords)
-
-    print(f"[DEBUG] classify_request() 원본: '{original_text}' → 정규화: '{text}'")
-    print(f"[DEBUG] 키워드 포함 여부 → image: {has_image_kw}, text: {has_text_kw}, question: {has_question_kw}")
+def classify_request(text):
+    normalized = normalize_mention(text)
+    families = find_request_families(normalized)
+    print(f"[DEBUG] classify_request() 원본: '{text}' → 정규화: '{normalized.text}' → 감지: {sorted(families)}")
 
-    matched = sum([has_image_kw, has_text_kw, has_question_kw])
-    if matched >= 2:
+    if len(families) >= 2:
         return "ambiguous"
-    elif has_image_kw:
-        return "reply_image"
-    elif has_text_kw:
-        return "reply_text"
-    elif has_question_kw:
-        return "reply_question"
-    else:
-        print("[DEBUG] 키워드 미감지 → 자동 응답 없음")
-        return None
+    for family in REQUEST_KEYWORDS:
+        if family in families:
+            return family
+    print("[DEBUG] 키워드 미감지 → 자동 응답 없음")
+    return None
 
 
 # 3. NG 키워드 감지 + 카테고리별 거절 + 블랙리스트 등록
@@ -653,183 +2009,437 @@ NG_RULES = {
     }
 }
 
-IGNORED_DID_FILE = "/tmp/ignored_dids.txt"
-
+# 블랙리스트(무시할 DID 목록)
+# - 상태 저장소(SQLite)의 ignored_dids 테이블을 메모리의 set으로 캐시하여 웜 컨테이너 간에 재사용
+# - 저장소의 data_version이 바뀌었을 때(다른 연결이 수정했을 때)만 다시 읽음
+# - 추가/해제는 메모리에서 모아두었다가 실행당 한 번 트랜잭션으로 반영
+class Blacklist:
+    def __init__(self, store):
+        self.store = store
+        self.dids = set()
+        self.version = None
+        self.loaded = False
+        self.added = set()
+        self.removed = set()
+
+    # 실행 시작 시 한 번 호출. 바뀐 것이 없다면 PRAGMA 한 번으로 끝남
+    def refresh(self):
+        if self.added or self.removed:
+            return
+        version = self.store.data_version()
+        if self.loaded and version == self.version:
+            return
+        self.dids = self.store.load_ignored_dids()
+        self.version = version
+        self.loaded = True
+        print(f"[DEBUG] 블랙리스트 로드: {len(self.dids)}건")
+
+    def __contains__(self, did):
+        if not self.loaded:
+            self.refresh()
+        return did.strip() in self.dids
+
+    def add(self, dids):
+        if not self.loaded:
+            self.refresh()
+        new = {d.strip() for d in dids if d and d.strip()} - self.dids
+        if new:
+            self.dids |= new
+            self.added |= new
+            self.removed -= new
+            print(f"[INFO] 블랙리스트 등록: {sorted(new)}")
+
+    def remove(self, dids):
+        if not self.loaded:
+            self.refresh()
+        gone = {d.strip() for d in dids if d} & self.dids
+        if gone:
+            self.dids -= gone
+            self.removed |= gone
+            self.added -= gone
+
+    def flush(self):
+        if not (self.added or self.removed):
+            return
+        with self.store.batch():
+            self.store.add_ignored_dids(sorted(self.added))
+            self.store.remove_ignored_dids(sorted(self.removed))
+        self.added.clear()
+        self.removed.clear()
+
+BLACKLIST = Blacklist(STATE)
+
+# NG_RULES를 import 시점에 한 번 컴파일. 값은 (카테고리 순서, 키워드 순서, 카테고리명)으로 우선순위를 보존
+def compile_ng_rules(rules):
+    matcher = AhoCorasick()
+    for cat_index, (category, rule) in enumerate(rules.items()):
+        for kw_index, kw in enumerate(rule["keywords"]):
+            matcher.add(kw, (cat_index, kw_index, category))
+    return matcher.build()
+
+NG_MATCHER = compile_ng_rules(NG_RULES)
+
+# 가장 우선순위가 높은(NG_RULES에서 먼저 나오는) 카테고리의 거절 메시지와 키워드 반환
 def check_ng_category(text):
-    for category, rule in NG_RULES.items():
-        for kw in rule["keywords"]:
-            if kw in text:
-                return random.choice(rule["messages"]), kw
-    return None, None
-
-
-def log_ng_mention(cid, author_did, keyword, message, text):
-    with open("/tmp/ng_log.txt", "a", encoding="utf-8") as f:
-        f.write(f"[{datetime.utcnow().isoformat()}Z] CID: {cid} | Author: {author_did}\n")
-        f.write(f"Keyword: '{keyword}' | Message: '{message}'\n")
-        f.write(f"Text: {text}\n\n")
-
-def log_mention(cid, author_did, text):
-    # 중복 멘션 텍스트 기록도 함께 처리
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    data = {}
-    if os.path.exists(MENTION_TEXT_HISTORY_FILE):
-        with open(MENTION_TEXT_HISTORY_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    if today not in data:
-        data[today] = {}
-    data[today].setdefault(author_did, []).append(text.strip())
-    with open(MENTION_TEXT_HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f)
-
-    # 멘션 로그 작성
-    with open("/tmp/mention_log.txt", "a", encoding="utf-8") as f:
-        f.write(f"[{datetime.utcnow().isoformat()}Z] CID: {cid} | Author: {author_did}\n")
-        f.write(f"Text: {text}\n\n")
+    best = min((value + (kw,) for _, kw, value in NG_MATCHER.iter_matches(text)), default=None)
+    if best is None:
+        return None, None
+    _, _, category, kw = best
+    return random.choice(NG_RULES[category]["messages"]), kw
+
 
 # 이미 처리한 멘션이면 skip
-PROCESSED_CID_FILE = "/tmp/processed_cids.txt"
+# - 처리한 CID는 상태 저장소(SQLite)의 processed_cids 테이블에 기록
+# - 웜 컨테이너에서는 메모리의 dict로 O(1) 조회하고, 테이블은 콜드 스타트 때 한 번만 읽음
+# - 새로 처리한 CID는 모아두었다가 실행당 한 번 flush
+# - 알림 조회 범위보다 오래된 CID는 TTL로 정리하여 기록이 끝없이 커지지 않게 함
+PROCESSED_CID_TTL = 7 * 24 * 3600 # 7일
+
+class ProcessedCidStore:
+    def __init__(self, store, ttl=PROCESSED_CID_TTL):
+        self.store = store
+        self.ttl = ttl
+        self.entries = None # cid → 처리 시각(epoch 초), 처음 조회할 때 로드
+        self.pending = []
+
+    def load(self):
+        if self.entries is not None:
+            return
+        self.entries = self.store.load_processed_cids(time.time() - self.ttl)
+        print(f"[DEBUG] 처리된 CID {len(self.entries)}건 로드")
+
+    def __contains__(self, cid):
+        self.load()
+        return cid in self.entries
+
+    def add(self, cid):
+        self.load()
+        if cid not in self.entries:
+            self.entries[cid] = time.time()
+            self.pending.append(cid)
+
+    # 새 항목을 저장하고 TTL이 지난 항목은 메모리와 테이블에서 함께 정리
+    def flush(self):
+        if self.entries is None:
+            return
+        cutoff = time.time() - self.ttl
+        expired = [cid for cid, ts in self.entries.items() if ts < cutoff]
+        for cid in expired:
+            del self.entries[cid]
+
+        with self.store.batch():
+            if self.pending:
+                self.store.add_processed_cids([(cid, self.entries[cid]) for cid in self.pending if cid in self.entries])
+            if expired:
+                removed = self.store.prune_processed_cids(cutoff)
+                print(f"[DEBUG] 처리된 CID 정리: {removed}건 만료, {len(self.entries)}건 유지")
+        self.pending.clear()
+
+PROCESSED_CIDS = ProcessedCidStore(STATE)
 
 def is_already_processed(cid):
-    if not os.path.exists(PROCESSED_CID_FILE):
-        return False
-    with open(PROCESSED_CID_FILE, "r", encoding="utf-8") as f:
-        return cid in [line.strip() for line in f if line.strip()]
+    return cid in PROCESSED_CIDS
 
 def mark_cid_processed(cid):
-    with open(PROCESSED_CID_FILE, "a", encoding="utf-8") as f:
-        f.write(cid + "\n")
-
+    PROCESSED_CIDS.add(cid)
+
+
+# 자동 포스트용 코퍼스
+# zip_builder.py가 배포 전에 quotes/posts의 모든 파일을 미리 파싱해 코퍼스 팩(quotes/corpus.pack)의 posts 섹션에 저장.
+# 각 항목에는 서두/본문 블록/클로징, 300자 단위로 나눈 청크(URL을 말미로 옮긴 최종 텍스트), 링크 facets, 이미지 파일명이 들어 있어
+# 런타임에는 파일 목록 조회, --- 분할, 청크 분할, URL 검사를 하지 않고 고른 항목 하나만 디코딩해서 바로 게시함.
+# 팩이 없으면(로컬 실행 등) 기존처럼 텍스트 파일을 직접 읽어 같은 방식으로 파싱.
+
+# 청크 하나를 게시용 텍스트로 가공
+# URL은 본문에서 빼고 말미에 줄바꿈으로 다시 붙임 (URL이 중복되어 facets가 두 번 붙는 걸 방지하고 미리보기를 유도)
+def render_chunk(chunk):
+    urls = URL_PATTERN.findall(chunk)
+    post_text = URL_PATTERN.sub('', chunk).strip()
+    if urls:
+        post_text += "\n\n" + "\n".join(urls)
+    return {
+        "text": post_text,
+        "facets": extract_facets(post_text, resolve_mentions=False), # 링크 facets (바이트 위치 포함)
+        "mentions": bool(MENTION_PATTERN.search(post_text)) # 게시할 때 핸들 → DID 변환이 필요한지 여부
+    }
 
-def main(auth):
-    print("[DEBUG] 메인 함수 시작")
-    work_title, content = load_random_work()
-    if not content:
-        return {"status": "error", "message": "No content loaded"}
+# 텍스트 블록을 청크로 나눠 가공
+# URL을 말미로 옮기면 줄바꿈이 늘어 제한을 넘을 수 있으므로, 넘친 청크는 넘친 만큼 작은 제한으로 다시 나눔
+def render_chunks(text):
+    for chunk in split_into_chunks(text):
+        items = [render_chunk(chunk)]
+        max_length, max_bytes = POST_MAX_GRAPHEMES, POST_MAX_BYTES
+        while not all(fits_post_limits(item["text"]) for item in items):
+            max_length -= max(0, max(grapheme_len(item["text"]) for item in items) - POST_MAX_GRAPHEMES)
+            max_bytes -= max(0, max(len(item["text"].encode("utf-8")) for item in items) - POST_MAX_BYTES)
+            if max_length <= 0 or max_bytes <= 0:
+                print(f"[WARNING] 청크를 제한 안으로 줄이지 못함: {chunk[:30]}...")
+                break
+            items = [render_chunk(piece) for piece in split_into_chunks(chunk, max_length, max_bytes)]
+        yield from items
 
+# 포스트 파일 하나(서두 --- 본문 --- 클로징)를 포스트 항목으로 파싱
+# 본문 블록과 청크는 제너레이터라서 게시하면서 필요한 만큼만 가공됨 (코퍼스 팩에 넣을 때는 materialize_post로 펼침)
+def parse_post(title, content):
     parts = content.split('---')
     head_text = parts[0].strip() if len(parts) >= 1 else ""
     body = parts[1].strip() if len(parts) >= 2 else ""
     closing = parts[2].strip() if len(parts) == 3 else ""
+    return {"title": title, "head": head_text, "blocks": PostBlocks(body), "closing": closing}
 
-    blocks = split_lines_with_images(body)
-
-    jwt = auth["accessJwt"]
-    did = auth["did"]
+# 본문 블록 목록. 순회할 때마다 본문을 다시 훑으므로 여러 번 순회할 수 있음
+# (이미지 블록만 먼저 훑어볼 때도 텍스트 블록의 청크는 가공하지 않음)
+class PostBlocks:
+    def __init__(self, body):
+        self.body = body
 
-    if head_text:
-        print("[DEBUG] 서두 텍스트 존재. 첫 포스트 생성.")
-        post = {
-            "$type": "app.bsky.feed.post",
-            "text": head_text,
-            "createdAt": now_timestamp(),
-            "langs": ["ko"]
-        }
-        root = parent = create_record(jwt, repo=did, collection="app.bsky.feed.post", record=post)
+    def __iter__(self):
+        return iter_post_blocks(self.body)
 
-    # 본문 블록 처리
-    for block in blocks:
-        print(f"[DEBUG] 블록 처리: {block['type']}")
+def iter_post_blocks(body):
+    for block in split_lines_with_images(body):
         if block["type"] == "text":
-            chunks = split_into_chunks(block["content"]) # 텍스트 블록을 작은 청크로 분할
-            for chunk in chunks: 
-                urls = re.findall(r'(https?://[^\s\)\]\}\<\>\"\']+)', chunk) # 텍스트 블록 안에서 URL을 추출
-                post_text = re.sub(r'(https?://[^\s\)\]\}\<\>\"\']+)', '', chunk).strip() # 기존 텍스트에서 URL을 제거하고 정리 (URL이 중복되어 facets가 두 번 붙는 걸 방지하기 위함)
-                
-                # URL이 존재하면, 텍스트 말미에 줄바꿈으로 URL을 다시 추가 (미리보기 유도)
-                if urls:
-                    post_text += "\n\n" + "\n".join(urls)
-                    
-                facets = extract_facets(post_text) # 가공된 최종 텍스트에서 facets를 추출
-
-                # Bluesky에 보낼 포스트 객체 구성
-                post = {
-                    "$type": "app.bsky.feed.post",
-                    "text": post_text,
-                    "createdAt": now_timestamp(),
-                    "langs": ["ko"]
-                }
+            yield {"type": "text", "chunks": render_chunks(block["content"])}
+        else:
+            yield block
 
-                if facets: # facets가 감지되었다면 포스트에 추가하여 하이퍼링크 기능 활성화
-                    post["facets"] = facets
-                    print(f"[DEBUG] facets 포함됨 (chunk): {facets}")
+def materialize_post(entry):
+    blocks = [
+        {"type": "text", "chunks": list(block["chunks"])} if block["type"] == "text" else block
+        for block in entry["blocks"]
+    ]
+    return dict(entry, blocks=blocks)
 
-                if parent: # 부모 포스트가 있으면 reply 정보 추가
-                    post["reply"] = {
-                        "root": {"cid": root["cid"], "uri": root["uri"]},
-                        "parent": {"cid": parent["cid"], "uri": parent["uri"]}
-                    }
-                parent = create_record(jwt, did, "app.bsky.feed.post", post) # 텍스트 포스트 생성
-                prev_text = chunk # 텍스트가 처리될 때 prev_text 갱신
+def build_post_entries(posts_dir=POSTS_DIR):
+    posts = []
+    for filename in sorted(os.listdir(posts_dir)):
+        if not filename.endswith(".txt"):
+            continue
+        with open(os.path.join(posts_dir, filename), encoding="utf-8") as f:
+            posts.append(materialize_post(parse_post(filename.replace(".txt", ""), f.read())))
+    return posts
+
+def read_question_files():
+    questions = {}
+    for filename in sorted(os.listdir(REPLY_QUESTION_DIR)):
+        if filename.endswith(".txt"):
+            with open(os.path.join(REPLY_QUESTION_DIR, filename), encoding="utf-8") as f:
+                questions[filename] = f.read()
+    return questions
+
+# quotes/posts, quotes/replies, quotes/reply_questions를 하나의 코퍼스 팩으로 묶음 (zip_builder.py에서 호출)
+def build_corpus_pack(path=CORPUS_PACK_FILE):
+    posts = build_post_entries() if os.path.isdir(POSTS_DIR) else []
+    replies = read_reply_chunks() if os.path.isdir(REPLIES_DIR) else []
+    questions = read_question_files() if os.path.isdir(REPLY_QUESTION_DIR) else {}
+    write_corpus_pack(
+        path,
+        {
+            "posts": [json.dumps(post, ensure_ascii=False) for post in posts],
+            "replies": replies,
+            "questions": list(questions.values())
+        },
+        {"questions": {name: index for index, name in enumerate(questions)}},
+        corpus_fingerprint()
+    )
+    print(f"[INFO] 코퍼스 팩 생성: {path} (포스트 {len(posts)}개, 답변 청크 {len(replies)}개, 질문 응답 {len(questions)}개)")
 
-        elif block["type"] == "image":
-            image_path = os.path.join(POSTS_DIR, block["filename"]) # 이미지 파일 경로
+def load_random_post():
+    pack = load_corpus_pack()
+    if pack and pack.count("posts"):
+        print(f"[DEBUG] 코퍼스 팩에서 랜덤 포스트 선택 ({pack.count('posts')}개 중)")
+        return json.loads(pack.random("posts"))
+    work_title, content = load_random_work()
+    if not content:
+        return None
+    return parse_post(work_title, content)
+
+# 스레드 게시 파이프라인
+# 포스트 항목 → 블록 → 청크 → 게시용 레코드를 제너레이터로 이어, 게시 루프가 레코드를 하나씩 받아 보냄.
+# 레코드의 reply는 빈 자리(root/parent = None)로 두고, 게시 루프가 직전에 만든 포스트의 ref로 채움.
+# 이미지 레코드의 blob도 빈 자리로 두고, 게시 루프가 PlannedPost.images의 파일을 ImagePrefetcher로 미리 준비해 create_image_post로 채움.
+PlannedPost = namedtuple("PlannedPost", ["record", "images"])
+
+def plan_text_post(text, facets=None):
+    post = {
+        "$type": "app.bsky.feed.post",
+        "text": text,
+        "createdAt": now_timestamp(),
+        "langs": ["ko"],
+        "reply": {"root": None, "parent": None}
+    }
+    if facets: # facets가 감지되었다면 포스트에 추가하여 하이퍼링크 기능 활성화
+        post["facets"] = facets
+        print(f"[DEBUG] facets 포함됨 (chunk): {facets}")
+    return PlannedPost(post, ())
+
+# 이미지가 포함된 포스트에는 이미지 파일명만 사용 (NSFW 라벨링은 하지 않고 모더레이션 봇에게 맡김)
+def image_post_text(filenames):
+    return f"📷 이미지: {', '.join(filenames)}"
+
+# 연달아 나오는 이미지 블록은 최대 IMAGE_POST_MAX_IMAGES개까지 한 포스트에 묶음
+def plan_image_post(filenames, image_paths):
+    post = plan_text_post(image_post_text(filenames)).record
+    post["embed"] = {
+        "$type": "app.bsky.embed.images",
+        "images": [{"alt": filename, "image": None} for filename in filenames]
+    }
+    return PlannedPost(post, tuple(image_paths))
+
+def plan_image_posts(images):
+    for start in range(0, len(images), IMAGE_POST_MAX_IMAGES):
+        filenames, image_paths = zip(*images[start:start + IMAGE_POST_MAX_IMAGES])
+        yield plan_image_post(filenames, image_paths)
+
+# 포스트 항목을 스레드 순서대로 게시용 레코드로 변환 (서두 → 본문 블록 → 클로징)
+# 스레드에 올라갈 이미지 파일 경로를 순서대로 반환 (본문 블록 중 이미지 블록만 훑음)
+def thread_image_paths(entry):
+    for block in entry["blocks"]:
+        if block["type"] == "image":
+            image_path = os.path.join(POSTS_DIR, block["filename"])
             if os.path.exists(image_path):
-                try:
-                    print(f"[DEBUG] 이미지 파일 존재: {image_path}")
-                    image_bytes, mime = compress_image(image_path) # 이미지 압축
-                    print(f"[DEBUG] 이미지 압축 및 변환 완료: {block['filename']}")
+                yield image_path
 
-                    blob = upload_blob(jwt, image_bytes, mime) # 이미지 블롭 업로드
-                    print(f"[DEBUG] 이미지 업로드 성공: {block['filename']}")
-
-                    # 이미지가 포함된 포스트에는 이미지 파일명만 사용하거나, 텍스트가 너무 길면 간단한 설명을 추가
-                    post_text = f"📷 이미지: {block['filename']}"
-
-                    image_entry = {
-                        "alt": block["filename"],
-                        "image": blob
-                    }
-
-                    # NSFW 라벨링 제거, 모더레이션 봇에게 맡기도록 처리
-                    post = {
-                        "$type": "app.bsky.feed.post",
-                        "text": post_text,  # 이미지 설명만 포함
-                        "createdAt": now_timestamp(),
-                        "langs": ["ko"],
-                        "embed": {
-                            "$type": "app.bsky.embed.images",
-                            "images": [image_entry]
-                        }
-                    }
+def plan_thread(entry):
+    if entry["head"]:
+        print("[DEBUG] 서두 텍스트 존재. 첫 포스트 생성.")
+        yield plan_text_post(entry["head"])
 
-                    if parent: # 부모 포스트가 있으면 reply 정보 추가
-                        post["reply"] = {
-                            "root": {"cid": root["cid"], "uri": root["uri"]},
-                            "parent": {"cid": parent["cid"], "uri": parent["uri"]}
-                        }
+    pending_images = [] # 아직 포스트로 만들지 않은 연속 이미지 블록 (filename, image_path)
+    for block in entry["blocks"]:
+        print(f"[DEBUG] 블록 처리: {block['type']}")
+        if block["type"] == "text":
+            yield from plan_image_posts(pending_images)
+            pending_images = []
+            for chunk in block["chunks"]:
+                # 핸들이 있는 청크만 DID 변환을 위해 facets를 다시 추출하고, 나머지는 미리 계산된 링크 facets 사용
+                facets = extract_facets(chunk["text"]) if chunk["mentions"] else chunk["facets"]
+                yield plan_text_post(chunk["text"], facets)
+        elif block["type"] == "image":
+            image_path = os.path.join(POSTS_DIR, block["filename"]) # 이미지 파일 경로
+            if os.path.exists(image_path):
+                print(f"[DEBUG] 이미지 파일 존재: {image_path}")
+                pending_images.append((block["filename"], image_path))
+    yield from plan_image_posts(pending_images)
+
+    if entry["closing"]: # 클로징 텍스트가 있다면 추가
+        yield plan_text_post(entry["closing"])
+
+# 이미지 미리 준비 (프리페치)
+# - 게시를 시작하기 전에 스레드의 이미지 블록만 따로 훑어(thread_image_paths), 모든 이미지의 압축(prepare_image)을 백그라운드에서 먼저 시작
+#   게시용 레코드는 여전히 plan_thread에서 하나씩 만들어지므로, 청크 가공과 핸들 → DID 변환은 게시 순서대로 진행됨
+# - 게시 루프가 포스트를 하나 만들 때마다 poll()로 압축이 끝난 이미지를 확인해, 재사용할 blob이 없으면 업로드를 걸어둠
+#   (blob 재사용 조회는 상태 DB를 쓰므로 게시 루프의 스레드에서만 함)
+# - 텍스트 포스트를 만드는 동안 이미지 작업이 뒤에서 진행되고, 이미지 포스트 차례가 오면 그 이미지의 결과만 기다림
+class ImagePrefetcher:
+    def __init__(self, jwt, image_paths=()):
+        self.jwt = jwt
+        self.prepares = {} # 이미지 경로 → prepare_image Future
+        self.uploads = {} # 이미지 경로 → upload_prepared_image Future (재사용할 blob이 있으면 None)
+        for image_path in image_paths:
+            self.prefetch(image_path)
+
+    def prefetch(self, image_path):
+        if image_path not in self.prepares:
+            self.prepares[image_path] = image_executor().submit(prepare_image, image_path)
+
+    # 압축이 끝났지만 아직 업로드를 걸지 않은 이미지의 업로드를 시작
+    def poll(self):
+        for image_path, future in self.prepares.items():
+            if image_path in self.uploads or not future.done() or future.exception():
+                continue
+            image = future.result()
+            if STATE.load_blob_ref(image.sha256):
+                self.uploads[image_path] = None
+            else:
+                self.uploads[image_path] = upload_executor().submit(upload_prepared_image, self.jwt, image)
+
+    # 준비된 이미지 (실패하면 None). 미리 걸어두지 않은 이미지는 지금 준비를 시작
+    def image(self, image_path):
+        self.prefetch(image_path)
+        try:
+            return self.prepares[image_path].result()
+        except Exception as e:
+            print(f"⚠️ 이미지 준비 실패: {image_path} ({e})")
+            return None
+
+    # 미리 업로드한 blob. 재사용 대상이거나 미리 업로드에 실패했으면 None (create_image_post가 다시 처리)
+    def uploaded_blob(self, image_path):
+        self.poll()
+        future = self.uploads.get(image_path)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"[WARNING] 이미지 미리 업로드 실패 → 게시할 때 다시 업로드: {image_path} ({e})")
+            return None
+
+    # 게시가 중간에 멈추면 아직 시작하지 않은 작업은 취소
+    def close(self):
+        for future in list(self.prepares.values()) + list(self.uploads.values()):
+            if future:
+                future.cancel()
+
+# 게시용 레코드를 순서대로 reply로 이어 게시. 이미지 포스트는 실패해도 건너뛰고 스레드를 이어감
+# image_paths: 미리 준비를 시작할 이미지 경로 (thread_image_paths)
+def publish_thread(jwt, did, planned_posts, image_paths=()):
+    prefetcher = ImagePrefetcher(jwt, image_paths)
+    root = parent = None
+    try:
+        for planned in planned_posts:
+            prefetcher.poll()
+            post = planned.record
+            if parent: # 부모 포스트가 있으면 reply 정보 추가
+                post["reply"] = {
+                    "root": {"cid": root["cid"], "uri": root["uri"]},
+                    "parent": {"cid": parent["cid"], "uri": parent["uri"]}
+                }
+            else:
+                del post["reply"]
 
-                    parent = create_record(jwt, did, "app.bsky.feed.post", post) # 이미지 포함 포스트 생성
-                    print(f"[DEBUG] 이미지 포함 포스트 업로드 완료: {block['filename']}")
-                    prev_text = None
+            if not planned.images:
+                parent = create_record(jwt, did, "app.bsky.feed.post", post)
+            else:
+                try:
+                    # 미리 최적화된 파일 또는 압축 결과. 준비에 실패한 이미지는 빼고 나머지만 게시
+                    prepared = [(image_entry, image_path, prefetcher.image(image_path)) for image_entry, image_path
+                                in zip(post["embed"]["images"], planned.images)]
+                    prepared = [item for item in prepared if item[2]]
+                    if not prepared:
+                        raise ValueError("준비된 이미지 없음")
+                    post["embed"]["images"] = [image_entry for image_entry, _, _ in prepared]
+                    post["text"] = image_post_text([image_entry["alt"] for image_entry, _, _ in prepared])
+                    images = [image for _, _, image in prepared]
+                    uploaded = [prefetcher.uploaded_blob(image_path) for _, image_path, _ in prepared]
+                    parent = create_image_post(jwt, did, post, images, uploaded) # 이미지 업로드(또는 blob 재사용) 후 포스트 생성
+                    print(f"[DEBUG] 이미지 포함 포스트 업로드 완료: {', '.join(planned.images)}")
                 except Exception as e:
-                    print(f"⚠️ 이미지 업로드 실패: {block['filename']} ({e})")
+                    print(f"⚠️ 이미지 업로드 실패: {', '.join(planned.images)} ({e})")
                     continue
+            root = root or parent # 서두 없이 시작하면 첫 포스트가 스레드의 root
+    finally:
+        prefetcher.close()
+    return root, parent
 
-    if closing:  # 클로징 텍스트가 있다면 추가
-        post = {
-            "$type": "app.bsky.feed.post",
-            "text": closing,
-            "createdAt": now_timestamp(),
-            "langs": ["ko"]
-        }
-        if parent:  # 부모 포스트가 있으면 reply 정보 추가
-            post["reply"] = {
-                "root": {"cid": root["cid"], "uri": root["uri"]},
-                "parent": {"cid": parent["cid"], "uri": parent["uri"]}
-            }
-        parent = create_record(jwt, did, "app.bsky.feed.post", post)  # 클로징 포스트 생성
+def main(auth):
+    print("[DEBUG] 메인 함수 시작")
+    entry = load_random_post()
+    if not entry:
+        return {"status": "error", "message": "No content loaded"}
+
+    publish_thread(auth["accessJwt"], auth["did"], plan_thread(entry), thread_image_paths(entry))
 
     return {
         "status": "success",
-        "message": f"Posted: {work_title} (text + images + closing)"
+        "message": f"Posted: {entry['title']} (text + images + closing)"
     }
 
 # AWS Lambda에서 진입점 역할을 하는 핸들러 함수
 def lambda_handler(event, context):
     print("[DEBUG] Lambda 핸들러 실행 시작")
     try:
-        auth = bluesky_login()
+        auth = get_session()
 
         # CloudWatch Events로부터 받은 이벤트 타입에 따라 처리 분기
         if "source" in event and event["source"] == "aws.events":
@@ -852,6 +2462,12 @@ def lambda_handler(event, context):
         return {"status": "ok"}
 
     except Exception as e:
+        # 토큰이 거부되었으면 캐시된 세션이 서버에서 만료·폐기된 것이므로 다음 실행에서 다시 로그인
+        if isinstance(e, requests.exceptions.HTTPError) and is_session_rejected(e):
+            invalidate_session()
         print(f"[ERROR] Lambda 전체 처리 중 오류: {e}")
         traceback.print_exc()
         return {"status": "error", "message": str(e)}
+
+    finally:
+        print(f"[DEBUG] XRPC 커넥션 통계: {XRPC.stats()}")
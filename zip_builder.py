@@ -5,11 +5,11 @@
 import zipfile
 import os
 
-# 기존 deployment.zip 삭제
 ZIP_FILENAME = "deployment.zip"
-if os.path.exists(ZIP_FILENAME):
-    os.remove(ZIP_FILENAME)
-    print(f"🗑️ 기존 {ZIP_FILENAME} 삭제 완료")
+
+# quotes/posts, quotes/reply_images의 이미지를 미리 Bluesky용 JPEG로 변환해 quotes/optimized에 넣습니다.
+# Lambda에서는 변환된 파일을 그대로 업로드하므로 Pillow를 불러오지 않습니다. (False로 바꾸면 Lambda에서 매번 압축)
+PREOPTIMIZE_IMAGES = True
 
 # 제외할 키워드 (폴더/경로에 포함되면 무조건 제외)
 EXCLUDE_KEYWORDS = {
@@ -22,7 +22,7 @@ EXCLUDE_KEYWORDS = {
 EXCLUDE_SUFFIX = {".dist-info", ".pyd"}
 
 # 제외할 특정 파일
-EXCLUDE_FILES = {"python.zip", "deployment.zip", "zip_python_layer.py", "zip_builder.py", "build_lambda_zip.py"}
+EXCLUDE_FILES = {"python.zip", "deployment.zip", "zip_python_layer.py", "zip_builder.py", "build_lambda_zip.py", "bench.py"}
 
 def should_exclude(path: str) -> bool:
     path_parts = path.split(os.sep)
@@ -54,6 +54,24 @@ def zip_dir_utf8(folder_path, zip_path):
                     zipf.writestr(info, f.read())
                 print(f"📦 추가됨: {relative_path}")
 
-zip_dir_utf8(".", "deployment.zip")
-print("✅ deployment.zip 생성 완료 (UTF-8 인코딩, 필요한 파일만 포함됨)")
+# 압축 전에 quotes/posts, quotes/replies, quotes/reply_questions를 미리 파싱해 코퍼스 팩(quotes/corpus.pack)을 생성.
+# Lambda에서는 이 파일 하나를 mmap으로 읽어 고른 항목만 디코딩하므로 매 실행마다 텍스트 파일을 열고 파싱하지 않습니다.
+def build_corpus():
+    import main # main.py의 파싱 함수를 그대로 사용 (requests, Pillow가 설치된 환경에서 실행)
+    if os.path.isdir("quotes"):
+        main.build_corpus_pack()
+        if PREOPTIMIZE_IMAGES:
+            main.build_optimized_images() # CPU 코어 수만큼 프로세스를 띄워 병렬 변환 (바뀐 이미지만)
+    else:
+        print("⚠️ quotes 폴더가 없어 코퍼스 팩 생성을 건너뜁니다.")
+
+if __name__ == "__main__":
+    # 기존 deployment.zip 삭제
+    if os.path.exists(ZIP_FILENAME):
+        os.remove(ZIP_FILENAME)
+        print(f"🗑️ 기존 {ZIP_FILENAME} 삭제 완료")
+
+    build_corpus()
+    zip_dir_utf8(".", ZIP_FILENAME)
+    print("✅ deployment.zip 생성 완료 (UTF-8 인코딩, 필요한 파일만 포함됨)")
 